@@ -0,0 +1,488 @@
+"""Write aggregated datasets for the `gen_agg` script.
+
+Aggregated files are either written from an already opened multi-file dataset, with one
+file per variable, or extended in place with history files that are newer than the
+last time step of the file.
+"""
+
+import glob
+import math
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    # The zstd and blosc filters of hdf5plugin are only found if they are registered
+    # before the HDF5 library is loaded by netCDF4 or h5py.
+    import hdf5plugin
+except ImportError:  # The optional `compression` extra.
+    hdf5plugin = None
+
+import cftime
+import dask
+import netCDF4
+import numpy as np
+import xarray as xr
+from dask.utils import parse_bytes
+
+from cesm_helper_scripts import profiling, reductions, running_mean
+from cesm_helper_scripts.history_index import FileIndex
+
+
+def time_chunk_for_memory(
+    dataset: xr.Dataset,
+    attrs: List[str],
+    max_memory: str,
+    num_workers: Optional[int] = None,
+) -> int:
+    """Find how many time steps can be held in memory at once.
+
+    Parameters
+    ----------
+    dataset : xr.Dataset
+        The dataset the attributes are read from.
+    attrs : List[str]
+        Names of the variables that will be written.
+    max_memory : str
+        Upper limit of the memory used by the write, e.g. `"4GB"`.
+    num_workers : Optional[int]
+        Number of threads dask is allowed to use. Defaults to the dask default.
+
+    Returns
+    -------
+    int
+        Number of time steps per chunk.
+    """
+    if num_workers is None:
+        num_workers = dask.system.CPU_COUNT
+    step_bytes = 0
+    for a in attrs:
+        da = dataset[a]
+        sizes = [s for d, s in da.sizes.items() if d != "time"]
+        step_bytes += da.dtype.itemsize * math.prod(sizes)
+    # Every worker holds one chunk being read and one being written.
+    budget = parse_bytes(max_memory) // (2 * num_workers)
+    return max(1, int(budget // max(step_bytes, 1)))
+
+
+def part_starts(
+    da: xr.DataArray,
+    part_size: Optional[str] = None,
+    part_years: Optional[int] = None,
+    bounds: Optional[xr.DataArray] = None,
+    end_stamps: bool = True,
+) -> List[int]:
+    """Find the first time step of each part file.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The variable that will be written.
+    part_size : Optional[str]
+        Target size of each part, e.g. `"4GB"`.
+    part_years : Optional[int]
+        Number of model years in each part, counted from the first year. Takes
+        precedence over `part_size`.
+    bounds : Optional[xr.DataArray]
+        The time bounds of `da`. Used to find the model year of each time step, see
+        `running_mean.step_midpoints`.
+    end_stamps : bool
+        If True, the time stamps are at the end of each averaging interval, as in
+        CESM. If False (e.g. for block means), the year is read from the time stamps.
+
+    Returns
+    -------
+    List[int]
+        The index of the first time step of each part. If neither `part_size` nor
+        `part_years` is given, all time steps go in one part, `[0]`.
+    """
+    n = da.sizes["time"]
+    if part_years is not None:
+        if end_stamps:
+            years = running_mean.step_midpoints(da.time, bounds).dt.year.values
+        else:
+            years = da.time.dt.year.values
+        # A new part starts where the model year crosses a multiple of `part_years`.
+        part = (years - years[0]) // part_years
+        return [0, *(np.flatnonzero(np.diff(part)) + 1).tolist()]
+    if part_size is not None:
+        step_bytes = da.dtype.itemsize * math.prod(
+            s for d, s in da.sizes.items() if d != "time"
+        )
+        steps = max(1, int(parse_bytes(part_size) // max(step_bytes, 1)))
+        return list(range(0, n, steps))
+    return [0]
+
+
+PROFILES = ("none", "timeseries", "map")
+COMPRESSIONS = ("zlib", "zstd", "blosc")
+
+
+def chunk_shape(
+    da: xr.DataArray, profile: str, target: str = "4MB"
+) -> Optional[Dict[str, int]]:
+    """Find the chunk shape of `da` for a given access pattern.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The variable that will be written.
+    profile : str
+        One of `PROFILES`. With `"timeseries"`, each chunk holds all time steps (up to
+        about `target` bytes) of all levels over a small lat/lon tile, which is fast
+        to read when looking at one column over time. With `"map"`, each chunk holds
+        one full map, i.e. one time step on one level. `"none"` leaves the chunking to
+        the library.
+    target : str
+        Approximate size of each chunk in the `"timeseries"` profile.
+
+    Returns
+    -------
+    Optional[Dict[str, int]]
+        The chunk size along each dimension, or None for the `"none"` profile.
+
+    Raises
+    ------
+    ValueError
+        If the profile is not known.
+    """
+    if profile == "none":
+        return None
+    sizes = dict(da.sizes)
+    if profile == "map":
+        return {d: s if d in ("lat", "lon") else 1 for d, s in sizes.items()}
+    if profile != "timeseries":
+        raise ValueError(f"profile must be one of {PROFILES}, not {profile}")
+    budget = parse_bytes(target) // da.dtype.itemsize
+    column = math.prod(s for d, s in sizes.items() if d not in ("lat", "lon"))
+    chunks = dict(sizes)
+    if column > budget:
+        # One column does not fit, so fewer time steps go in each chunk.
+        rest = max(column // sizes.get("time", 1), 1)
+        chunks["time"] = max(1, budget // rest)
+        tile = 1
+    else:
+        tile = max(1, math.isqrt(budget // column))
+    for d in ("lat", "lon"):
+        if d in chunks:
+            chunks[d] = min(sizes[d], tile)
+    return chunks
+
+
+def _compression(compression: str, level: int) -> Tuple[Dict, str]:
+    if compression == "zlib":
+        return {"zlib": True, "complevel": level, "shuffle": True}, "netcdf4"
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"compression must be one of {COMPRESSIONS}")
+    # zstd and blosc are HDF5 filter plugins. They are written with h5netcdf, and
+    # hdf5plugin provides the filters.
+    if hdf5plugin is None:
+        raise ImportError(f"{compression} compression needs hdf5plugin")
+    if compression == "zstd":
+        return {**hdf5plugin.Zstd(clevel=level), "shuffle": True}, "h5netcdf"
+    return {**hdf5plugin.Blosc(cname="zstd", clevel=level)}, "h5netcdf"
+
+
+def _to_netcdf(
+    da: xr.DataArray,
+    out: str,
+    profile: str = "none",
+    compression: Optional[str] = None,
+    level: int = 4,
+):
+    ds = da.to_dataset()
+    ds.attrs["history"] = f"Time span: From {ds.time.data[0]} to {ds.time.data[-1]}"
+    chunks = chunk_shape(da, profile)
+    if out.endswith(".zarr"):
+        # Zarr chunks follow the dask chunks. The default zarr compressor is used.
+        ds[da.name].encoding = {}
+        if chunks is not None:
+            ds = ds.chunk(chunks)
+        return ds.to_zarr(out, mode="w-", compute=False)
+    encoding: Dict = {}
+    engine = None
+    if compression is not None:
+        encoding, engine = _compression(compression, level)
+    if chunks is not None:
+        encoding["chunksizes"] = tuple(chunks[d] for d in da.dims)
+    if encoding:
+        # The encoding of the history files (e.g. contiguous) does not apply here.
+        ds[da.name].encoding = {}
+    return ds.to_netcdf(
+        out,
+        unlimited_dims="time",
+        compute=False,
+        engine=engine,
+        encoding={da.name: encoding} if encoding else None,
+    )
+
+
+def part_writes(
+    da: xr.DataArray, out: str, starts: List[int], **kwargs
+) -> Dict[str, Any]:
+    """Set up the writes of consecutive time windows of `da` to part files.
+
+    The parts are named `<out>-1.nc`, `<out>-2.nc`, ..., where `out` is stripped of
+    the `.nc` extension. Parts that already exist are skipped. If there is only one
+    part, `out` is written as a single file.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The variable that will be written.
+    out : str
+        The path to the output file.
+    starts : List[int]
+        The first time step of each part, see `part_starts`.
+    **kwargs
+        The `profile`, `compression` and `level` of the output files.
+
+    Returns
+    -------
+    Dict[str, Any]
+        Delayed writes by file name, to be computed with `dask.compute`.
+    """
+    if len(starts) < 2:
+        return {out: _to_netcdf(da, out, **kwargs)}
+    writes = {}
+    base = out[:-3] if out.endswith(".nc") else out
+    for part, (start, stop) in enumerate(zip(starts, [*starts[1:], None]), start=1):
+        file = f"{base}-{part}.nc"
+        if os.path.exists(file):
+            print(f"\tPart {part} already exists, skipping...")
+            continue
+        chunk = da.isel(time=slice(start, stop))
+        writes[file] = _to_netcdf(chunk, file, **kwargs)
+    return writes
+
+
+def open_parts(out: str, **kwargs) -> xr.Dataset:
+    """Open all parts written by `part_writes` as one dataset.
+
+    Parameters
+    ----------
+    out : str
+        The path given to `part_writes`.
+    **kwargs
+        Keyword arguments passed on to `xr.open_mfdataset`.
+
+    Returns
+    -------
+    xr.Dataset
+        The parts concatenated along time.
+
+    Raises
+    ------
+    FileNotFoundError
+        If no parts are found.
+    """
+    base = out[:-3] if out.endswith(".nc") else out
+    parts = glob.glob(f"{glob.escape(base)}-*.nc")
+    parts = [p for p in parts if p[len(base) + 1 : -3].isdigit()]
+    if not parts:
+        if os.path.exists(out):
+            return xr.open_mfdataset([out], **kwargs)
+        raise FileNotFoundError(f"Cannot find any parts of {out}.")
+    parts.sort(key=lambda p: int(p[len(base) + 1 : -3]))
+    return xr.open_mfdataset(parts, combine="nested", concat_dim="time", **kwargs)
+
+
+def write(
+    dataset: xr.Dataset,
+    targets: Dict[str, str],
+    window: Optional[int] = None,
+    center: bool = False,
+    block: Optional[str] = None,
+    max_memory: Optional[str] = None,
+    num_workers: Optional[int] = None,
+    part_size: Optional[str] = None,
+    part_years: Optional[int] = None,
+    profile: str = "none",
+    compression: Optional[str] = None,
+    level: int = 4,
+    reduce: Optional[List[str]] = None,
+    levels: Optional[List[float]] = None,
+    full: bool = True,
+    keep_weights: bool = False,
+) -> List[str]:
+    """Write every variable in `targets` to its own file(s) with one compute.
+
+    Parameters
+    ----------
+    dataset : xr.Dataset
+        The aggregated (lazy) dataset.
+    targets : Dict[str, str]
+        Mapping from variable name to the file it should be saved to.
+    window : Optional[int]
+        If given, a running mean over this many time steps, weighted by the length
+        of each time step, is computed before saving.
+    center : bool
+        If True, the running mean is centered.
+    block : Optional[str]
+        If given, the mean over each year or season is saved, see
+        `running_mean.block_mean`.
+    max_memory : Optional[str]
+        Cap on the memory used while writing, e.g. `"4GB"`. If not given, the chunks
+        of the input dataset are used as they are.
+    num_workers : Optional[int]
+        Number of threads used by dask.
+    part_size : Optional[str]
+        If given, variables are split into parts of about this size, see
+        `part_starts`.
+    part_years : Optional[int]
+        If given, variables are split into parts of this many model years.
+    profile : str
+        Chunk profile of the output, see `chunk_shape`.
+    compression : Optional[str]
+        One of `COMPRESSIONS`. No compression if not given. Ignored for Zarr output.
+    level : int
+        Compression level.
+    reduce : Optional[List[str]]
+        Reductions (see `reductions`) that are computed in the same pass, and saved
+        next to the full fields, e.g. as `<target>_global.nc`.
+    levels : Optional[List[float]]
+        If given, only the levels closest to these (in hPa) are saved.
+    full : bool
+        If False, only the reductions are saved.
+    keep_weights : bool
+        If True, the Gaussian weights `gw` are saved with the full fields, e.g. in the
+        partial files of `partial_agg`, so that the reductions done in the merge use
+        them.
+
+    Returns
+    -------
+    List[str]
+        The files that were written, including the parts and the reductions. Parts
+        that already existed are left out.
+    """
+    attrs = list(targets)
+    bounds = dataset.get("time_bnds")
+    gw = dataset.get("gw")
+    weights = running_mean.step_weights(dataset.time, bounds)
+    if max_memory is not None:
+        steps = time_chunk_for_memory(dataset, attrs, max_memory, num_workers)
+        dataset = dataset[attrs].chunk({"time": steps})
+    # All parts and variables are computed together, so the parts are written in
+    # parallel and the input chunks are read once. The writes are also set up with
+    # the threaded scheduler, since xarray picks its file locks from the scheduler
+    # (which matters when running inside a dask.distributed worker).
+    with dask.config.set(scheduler="threads", num_workers=num_workers):
+        with profiling.stage("setup writes"):
+            writes: Dict[str, Any] = {}
+            for a, out in targets.items():
+                da = dataset[a]
+                if not keep_weights:
+                    da = da.drop_vars("gw", errors="ignore")
+                if window is not None:
+                    da = running_mean.running_mean(da, window, center, weights)
+                if block is not None:
+                    da = running_mean.block_mean(da, block, weights, bounds)
+                da = reductions.select_levels(da, levels)
+                kwargs = dict(profile=profile, compression=compression, level=level)
+                base, ext = os.path.splitext(out)
+                for end, reduced in reductions.reduce(da, reduce or [], gw).items():
+                    name = f"{base}{end}{ext}"
+                    writes[name] = _to_netcdf(reduced, name, **kwargs)
+                if not full:
+                    continue
+                if out.endswith(".zarr"):
+                    # A zarr store is already split into chunks, so there are no parts.
+                    starts = [0]
+                else:
+                    # Block means are labelled by the start of each block.
+                    starts = part_starts(
+                        da,
+                        part_size,
+                        part_years,
+                        bounds if block is None else None,
+                        end_stamps=block is None,
+                    )
+                writes.update(part_writes(da, out, starts, **kwargs))
+        # Reading, computing and storing are fused in one graph, so they are told
+        # apart by the time of each kind of task in the profile.
+        with profiling.stage("compute"):
+            dask.compute(*writes.values())
+    return list(writes)
+
+
+def last_time(target: str):
+    """Return the last time stamp of an aggregated file.
+
+    Parameters
+    ----------
+    target : str
+        Path to an aggregated netCDF file.
+
+    Returns
+    -------
+    cftime.datetime
+        The last time stamp, in the calendar of the file.
+    """
+    with netCDF4.Dataset(target, "r") as ds:
+        time = ds.variables["time"]
+        return cftime.num2date(
+            time[-1], time.units, getattr(time, "calendar", "standard")
+        )
+
+
+def append(target: str, index: FileIndex) -> int:
+    """Append the time steps of the indexed files that are newer than `target`.
+
+    Only the history files with time stamps after the last time stamp of the target
+    are opened, and the data is written in place along the unlimited `time`
+    dimension, one input file at a time. The cost therefore scales with the amount of
+    new data, not with the length of the aggregated file.
+
+    Parameters
+    ----------
+    target : str
+        Path to an aggregated netCDF file, as created by `gen_agg`.
+    index : FileIndex
+        Header index of the history files that may contain new data.
+
+    Returns
+    -------
+    int
+        The number of time steps that were appended.
+
+    Raises
+    ------
+    ValueError
+        If the history files do not contain the variables of the target file.
+    """
+    last = last_time(target)
+    new_files = [f for f in index.files if _newer(index, f, last)]
+    if not new_files:
+        return 0
+    with netCDF4.Dataset(target, "r+") as out:
+        attrs = [
+            name
+            for name, var in out.variables.items()
+            if "time" in var.dimensions and name != "time"
+        ]
+        if missing := [a for a in attrs if index.missing(a)]:
+            raise ValueError(f"The history files are missing the variables {missing}")
+        time = out.variables["time"]
+        calendar = getattr(time, "calendar", "standard")
+        n = start = len(time)
+        for file in new_files:
+            # The time stamps are known from the index, so the time is not decoded.
+            dates = index.times(file)
+            newer = dates > last
+            with xr.open_dataset(file, decode_times=False) as ds:
+                ds = ds[attrs].isel(time=newer)
+                k = len(ds.time)
+                time[n : n + k] = cftime.date2num(dates[newer], time.units, calendar)
+                for a in attrs:
+                    out.variables[a][n : n + k] = (
+                        ds[a].transpose(*out.variables[a].dimensions).values
+                    )
+                n += k
+        first = cftime.num2date(time[0], time.units, calendar)
+        end = cftime.num2date(time[-1], time.units, calendar)
+        out.history = f"Time span: From {first} to {end}"
+    return n - start
+
+
+def _newer(index: FileIndex, file: str, last) -> bool:
+    times = index.times(file)
+    return bool(len(times)) and max(times) > last
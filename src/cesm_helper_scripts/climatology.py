@@ -0,0 +1,321 @@
+"""Streaming climatologies and anomalies of aggregated files.
+
+The climatology (mean, count and optionally the variance for each month or day of the
+year) is built in one pass over the time chunks of the data, with accumulators that
+are updated one chunk at a time (Chan et al.'s parallel form of Welford's algorithm).
+The anomalies are then written in a second pass, again one time chunk at a time, so
+the memory used is bounded by the chunk size and the size of the climatology, not by
+the length of the run.
+
+The months and days follow the calendar of the file, `noleap` for CESM. The middle of
+each averaging interval is used, since CESM puts the time stamp at the end of the
+interval. It is found from the time bounds if present, and else from the time stamps.
+"""
+
+import functools
+import os
+from typing import Dict, List, Optional, Tuple
+
+import dask
+import dask.array
+import numpy as np
+import xarray as xr
+from dask.utils import format_bytes, parse_bytes
+
+from cesm_helper_scripts import aggregate, running_mean
+
+FREQS = {"month": "month", "day": "dayofyear"}
+
+
+def group_index(
+    time: xr.DataArray, freq: str = "month", bounds: Optional[xr.DataArray] = None
+) -> Tuple[np.ndarray, int]:
+    """Return the month or day of the year of each time step, counted from 0.
+
+    Parameters
+    ----------
+    time : xr.DataArray
+        The time coordinate.
+    freq : str
+        One of the keys in `FREQS`.
+    bounds : Optional[xr.DataArray]
+        The time bounds. The middle of each interval is used, see
+        `running_mean.step_midpoints`. Without bounds (e.g. in files written by
+        `gen_agg`), each interval is taken to end at its time stamp, as in CESM.
+
+    Returns
+    -------
+    Tuple[np.ndarray, int]
+        The group of each time step, and the number of groups.
+
+    Raises
+    ------
+    ValueError
+        If `freq` is not known.
+    """
+    if freq not in FREQS:
+        raise ValueError(f"freq must be one of {list(FREQS)}, not {freq}")
+    time = running_mean.step_midpoints(time, bounds)
+    groups = getattr(time.dt, FREQS[freq]).values - 1
+    if freq == "month":
+        return groups, 12
+    calendar = getattr(time.dt, "calendar", "standard")
+    return groups, 365 if calendar in ("noleap", "365_day") else 366
+
+
+class Accumulator:
+    """Count, mean and sum of squared deviations for each group, updated by chunk.
+
+    Parameters
+    ----------
+    ngroups : int
+        The number of groups.
+    shape : Tuple[int, ...]
+        The shape of each time step.
+    variance : bool
+        If True, the sum of squared deviations (M2) is also kept.
+    """
+
+    def __init__(self, ngroups: int, shape: Tuple[int, ...], variance: bool) -> None:
+        self.count = np.zeros((ngroups, *shape), dtype="i8")
+        self.mean = np.zeros((ngroups, *shape), dtype="f8")
+        self.m2 = np.zeros((ngroups, *shape), dtype="f8") if variance else None
+
+    def update(self, values: np.ndarray, groups: np.ndarray) -> None:
+        """Add a chunk of time steps.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            The data, with time along the first axis. Missing values are NaN.
+        groups : np.ndarray
+            The group of each time step.
+        """
+        for g in np.unique(groups):
+            block = values[groups == g].astype("f8", copy=False)
+            n_b = np.count_nonzero(~np.isnan(block), axis=0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean_b = np.nansum(block, axis=0) / n_b
+                n = self.count[g]
+                total = n + n_b
+                delta = np.where(n_b > 0, mean_b - self.mean[g], 0.0)
+                self.mean[g] += np.where(total > 0, delta * n_b / total, 0.0)
+                if self.m2 is not None:
+                    m2_b = np.nansum((block - mean_b) ** 2, axis=0)
+                    self.m2[g] += np.where(
+                        total > 0, m2_b + delta**2 * n * n_b / total, 0.0
+                    )
+            self.count[g] = total
+
+    def result(self) -> Dict[str, np.ndarray]:
+        """Return the mean, count and (if kept) the sample variance."""
+        out = {"mean": np.where(self.count > 0, self.mean, np.nan)}
+        out["count"] = self.count
+        if self.m2 is not None:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out["var"] = np.where(
+                    self.count > 1, self.m2 / (self.count - 1), np.nan
+                )
+        return out
+
+
+def accumulator_bytes(
+    ds: xr.Dataset, variables: List[str], ngroups: int, variance: bool
+) -> int:
+    """Return the memory used by the climatologies of `variables`.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The dataset the variables are read from.
+    variables : List[str]
+        The variables.
+    ngroups : int
+        The number of groups, see `group_index`.
+    variance : bool
+        If True, the sum of squared deviations is also kept.
+
+    Returns
+    -------
+    int
+        The size in bytes of the count, mean and M2 of every variable, see
+        `Accumulator`. The climatology of each variable is kept (with about the same
+        size) until the anomalies are written.
+    """
+    arrays = 3 if variance else 2
+    total = 0
+    for v in variables:
+        step = int(np.prod([s for d, s in ds[v].sizes.items() if d != "time"]))
+        total += 8 * arrays * ngroups * step
+    return total
+
+
+def climatology(
+    da: xr.DataArray,
+    freq: str = "month",
+    variance: bool = False,
+    bounds: Optional[xr.DataArray] = None,
+) -> xr.Dataset:
+    """Compute the climatology in one pass over the time chunks of `da`.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The data, with time as the first dimension. If it is a dask array, one time
+        chunk is held in memory at a time.
+    freq : str
+        One of the keys in `FREQS`.
+    variance : bool
+        If True, the variance is also computed.
+    bounds : Optional[xr.DataArray]
+        The time bounds, see `group_index`.
+
+    Returns
+    -------
+    xr.Dataset
+        `<name>` (the mean), `<name>_count` and `<name>_var` for each group.
+    """
+    da = da.transpose("time", ...)
+    groups, ngroups = group_index(da.time, freq, bounds)
+    acc = Accumulator(ngroups, da.shape[1:], variance)
+    steps = da.chunks[0] if da.chunks is not None else (da.sizes["time"],)
+    start = 0
+    for n in steps:
+        block = da.isel(time=slice(start, start + n)).values
+        acc.update(block, groups[start : start + n])
+        start += n
+    dim = FREQS[freq]
+    coords = {dim: np.arange(1, ngroups + 1)}
+    coords.update({d: da[d] for d in da.dims[1:] if d in da.coords})
+    dims = (dim, *da.dims[1:])
+    out = xr.Dataset(coords=coords)
+    for key, values in acc.result().items():
+        name = da.name if key == "mean" else f"{da.name}_{key}"
+        if key != "count":
+            values = values.astype(np.result_type(da.dtype, np.float32))
+        out[name] = xr.DataArray(values, dims=dims, attrs=da.attrs)
+    out[f"{da.name}_count"].attrs = {"long_name": f"Number of values of {da.name}"}
+    return out
+
+
+def _subtract(block: np.ndarray, groups: np.ndarray, mean: np.ndarray, block_info=None):
+    location = block_info[0]["array-location"]
+    start, stop = location[0]
+    index = (groups[start:stop], *[slice(a, b) for a, b in location[1:]])
+    return (block - mean[index]).astype(block.dtype, copy=False)
+
+
+def anomalies(
+    da: xr.DataArray,
+    clim: xr.Dataset,
+    freq: str = "month",
+    bounds: Optional[xr.DataArray] = None,
+) -> xr.DataArray:
+    """Subtract the climatology from `da`, lazily and one chunk at a time.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The data, see `climatology`.
+    clim : xr.Dataset
+        The climatology of `da`, from `climatology`.
+    freq : str
+        One of the keys in `FREQS`, the same as used for `clim`.
+    bounds : Optional[xr.DataArray]
+        The time bounds, see `group_index`.
+
+    Returns
+    -------
+    xr.DataArray
+        The anomalies, with the same dimensions and chunks as `da`.
+    """
+    dims = da.dims
+    da = da.transpose("time", ...)
+    if da.chunks is None:
+        da = da.chunk()
+    groups, _ = group_index(da.time, freq, bounds)
+    mean = clim[da.name].transpose(FREQS[freq], ...).values
+    subtract = functools.partial(_subtract, groups=groups, mean=mean)
+    data = dask.array.map_blocks(subtract, da.data, dtype=da.dtype)
+    out = da.copy(data=data)
+    return out.transpose(*dims)
+
+
+def run(
+    filename: str,
+    variables: Optional[List[str]] = None,
+    freq: str = "month",
+    variance: bool = False,
+    max_memory: str = "1GB",
+    num_workers: Optional[int] = None,
+) -> Tuple[str, str]:
+    """Write the climatology and the anomalies of an aggregated file.
+
+    Parameters
+    ----------
+    filename : str
+        The `.nc` file or `.zarr` store.
+    variables : Optional[List[str]]
+        The variables to use. All floating point variables over time if not given.
+    freq : str
+        One of the keys in `FREQS`.
+    variance : bool
+        If True, the variance is also saved in the climatology.
+    max_memory : str
+        Bound on the memory used by the climatology and the data in each pass, e.g.
+        `"4GB"`. What is left after the climatology sets the number of time steps in
+        each chunk.
+    num_workers : Optional[int]
+        Number of threads writing the anomalies, each holding its own chunks. Defaults
+        to the dask default.
+
+    Returns
+    -------
+    Tuple[str, str]
+        The files `<base>_climatology<ext>` and `<base>_anomalies<ext>`.
+
+    Raises
+    ------
+    ValueError
+        If the climatology alone needs more than `max_memory`.
+    """
+    zarr = filename.rstrip("/").endswith(".zarr")
+    base, ext = os.path.splitext(filename.rstrip("/"))
+    ds = xr.open_dataset(filename, chunks={}, engine="zarr" if zarr else None)
+    bounds = ds.get("time_bnds")
+    if variables is None:
+        variables = [v for v in ds.data_vars if "time" in ds[v].dims]
+        variables = [
+            v for v in variables if ds[v].dtype.kind == "f" and v != "time_bnds"
+        ]
+    _, ngroups = group_index(ds.time, freq, bounds)
+    budget = parse_bytes(max_memory) - accumulator_bytes(
+        ds, variables, ngroups, variance
+    )
+    if budget <= 0:
+        raise ValueError(
+            f"the {freq} climatology of {variables} needs about"
+            + f" {format_bytes(parse_bytes(max_memory) - budget)}, more than"
+            + f" max_memory ({max_memory})"
+        )
+    # Each chunk is also converted to float64.
+    num_workers = (
+        num_workers or dask.config.get("num_workers", None) or dask.system.CPU_COUNT
+    )
+    steps = aggregate.time_chunk_for_memory(ds, variables, str(budget), num_workers)
+    steps //= 2
+    ds = ds.chunk({"time": max(1, steps)})
+    clim = xr.merge([climatology(ds[v], freq, variance, bounds) for v in variables])
+    clim.attrs = ds.attrs
+    anom = xr.Dataset({v: anomalies(ds[v], clim, freq, bounds) for v in variables})
+    anom.attrs = ds.attrs
+    names = f"{base}_climatology{ext}", f"{base}_anomalies{ext}"
+    with dask.config.set(scheduler="threads", num_workers=num_workers):
+        if zarr:
+            clim.to_zarr(names[0], mode="w")
+            anom.to_zarr(names[1], mode="w")
+        else:
+            clim.to_netcdf(names[0])
+            anom.to_netcdf(names[1])
+    ds.close()
+    return names
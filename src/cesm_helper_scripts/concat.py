@@ -0,0 +1,149 @@
+"""Open many CESM history files on the same grid as one lazy dataset.
+
+`xr.open_mfdataset` opens every file, decodes it and compares the coordinates of all
+files before concatenating them. History files from one run are on the same grid, so
+this is mostly wasted work. Here, the coordinates and the variable metadata are taken
+from the first file, while the time stamps of all other files are taken from the
+header index (see `history_index`). Each file then becomes one chunk along time that
+is only opened when the data is computed.
+
+The netCDF/HDF5 libraries are not thread safe, so every read holds the lock that xarray
+also uses. The chunks are therefore read one at a time, also when dask computes them
+with many threads. The time saved is in opening the files, not in reading them; use
+processes (`gen_agg --workers`) to read files in parallel.
+"""
+
+from typing import Dict, List, Optional
+
+import cftime
+import dask.array
+import netCDF4
+import numpy as np
+import xarray as xr
+from dask import delayed
+from xarray.backends.locks import HDF5_LOCK
+
+from cesm_helper_scripts.history_index import FileIndex
+
+
+def _read(file: str, name: str, dtype: np.dtype) -> np.ndarray:
+    # The netCDF/HDF5 libraries are not thread safe. Use the same lock as xarray, so
+    # that reading here and writing with xarray is never done at the same time.
+    with HDF5_LOCK:
+        with netCDF4.Dataset(file, "r") as ds:
+            values = ds.variables[name][:]
+    values = values.astype(dtype)
+    if np.ma.isMaskedArray(values):
+        return np.ma.filled(values, np.nan) if dtype.kind == "f" else values.data
+    return values
+
+
+def homogeneous(index: FileIndex) -> bool:
+    """Check if all indexed files are on the same grid with the same variables.
+
+    Parameters
+    ----------
+    index : FileIndex
+        Header index of the files.
+
+    Returns
+    -------
+    bool
+        True if the grids, the dimensions other than time, the variables and the
+        calendars are the same in all files.
+    """
+
+    def _key(entry: Dict):
+        dims = {d: s for d, s in entry["dims"].items() if d != "time"}
+        variables = {k: v["dims"] for k, v in entry["variables"].items()}
+        return entry.get("grid"), dims, variables, entry["calendar"]
+
+    keys = [_key(index.entry(f)) for f in index.files]
+    return all(k == keys[0] for k in keys[1:])
+
+
+def _in_units(index: FileIndex, file: str, key: str, units: str, calendar: str):
+    entry = index.entry(file)
+    values = np.asarray(entry[key], dtype=float)
+    if entry["units"] == units:
+        return values
+    dates = cftime.num2date(values, entry["units"], calendar)
+    return np.asarray(cftime.date2num(dates, units, calendar), dtype=float)
+
+
+def open_history(
+    files: List[str], index: Optional[FileIndex] = None, fast: bool = True
+) -> xr.Dataset:
+    """Open history files as one dataset concatenated along time.
+
+    Parameters
+    ----------
+    files : List[str]
+        Paths to the history files.
+    index : Optional[FileIndex]
+        Header index of `files`. Created if not given.
+    fast : bool
+        If False, or if the files are not on the same grid, the files are opened with
+        `xr.open_mfdataset`. If True, the files are read one at a time behind a global
+        lock, see the module docstring.
+
+    Returns
+    -------
+    xr.Dataset
+        The decoded, lazy dataset.
+
+    Raises
+    ------
+    FileNotFoundError
+        If `files` is empty.
+    """
+    if not files:
+        raise FileNotFoundError("no history files were given")
+    index = index or FileIndex(files)
+    if not fast or not homogeneous(index):
+        # See issue https://github.com/pydata/xarray/issues/3961
+        return xr.decode_cf(xr.open_mfdataset(files, lock=False))
+    given = set(files)
+    files = [f for f in index.files if f in given]
+    files.sort(key=lambda f: index.time_span(f) or (np.inf, np.inf))
+    first = index.entry(files[0])
+    units, calendar = first["units"], first["calendar"]
+    lengths = [len(index.entry(f)["time"]) for f in files]
+    variables: Dict[str, xr.Variable] = {}
+    with xr.open_dataset(files[0], decode_times=False) as template:
+        for name, var in template.variables.items():
+            if "time" not in var.dims:
+                variables[name] = var.load().copy()
+            elif name == "time":
+                values = np.concatenate(
+                    [_in_units(index, f, "time", units, calendar) for f in files]
+                )
+                variables[name] = xr.Variable(
+                    "time", values, var.attrs, var.encoding
+                ).to_index_variable()
+            elif "bounds" in first and name == template.time.attrs.get("bounds"):
+                values = np.concatenate(
+                    [_in_units(index, f, "bounds", units, calendar) for f in files]
+                )
+                variables[name] = xr.Variable(var.dims, values, var.attrs, var.encoding)
+            elif var.dtype.kind in "fiu":
+                axis = var.dims.index("time")
+                chunks = [
+                    dask.array.from_delayed(
+                        delayed(_read)(f, name, var.dtype),
+                        shape=(*var.shape[:axis], n, *var.shape[axis + 1 :]),
+                        dtype=var.dtype,
+                    )
+                    for f, n in zip(files, lengths)
+                ]
+                variables[name] = xr.Variable(
+                    var.dims,
+                    dask.array.concatenate(chunks, axis=axis),
+                    var.attrs,
+                    var.encoding,
+                )
+            # Variables of characters (e.g. `date_written`) are left out.
+        attrs = template.attrs
+    coords = [n for n in variables if n in template.coords]
+    ds = xr.Dataset(variables, attrs=attrs).set_coords(coords)
+    return xr.decode_cf(ds)
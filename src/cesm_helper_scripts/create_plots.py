@@ -7,8 +7,10 @@ found in the file.
 
 Usage:
     temp_plots -i single_file.nc -p up/three/layers -sp save_two_layers_below_input -o output_name -plt simple sphere anim
-"""
 
+The plots themselves are in `cesm_helper_scripts.plots`, which is only imported once the
+arguments are checked, so `cplt --help` does not import the plotting backends.
+"""
 
 import argparse
 import datetime
@@ -16,16 +18,7 @@ import glob
 import os
 import sys
 
-import animatplot as amp
-import cftime
-import cosmoplots
-import matplotlib
-import matplotlib.colors as colors
-import matplotlib.pyplot as plt
-import numpy as np
-import xarray as xr
-from mpl_toolkits.basemap import Basemap
-from xmovie import Movie
+from cesm_helper_scripts import profiling
 
 parser = argparse.ArgumentParser(
     description="Create plots and animations wrt. the attribute of a .nc file. \
@@ -105,59 +98,56 @@ parser.add_argument(
     type=int,
     help="Frames per second for the output movie file. Only relevant for `.mp4` files.",
 )
-
-args = parser.parse_args()
-if args.maps:
-    print(
-        "Find all available map projections at "
-        + "https://matplotlib.org/basemap/api/basemap_api.html#module-mpl_toolkits.basemap"
-    )
-    sys.exit(0)
-# Correct the input argument
-if args.input is None:
-    raise ValueError("you must give the input files")
-if args.plots is None:
-    raise ValueError(
-        "you must specify what kind of plot you want (simple, sphere, anim)"
-    )
-if not set(args.plots).issubset({"simple", "sphere", "anim"}):
-    raise ValueError("you must choose between: simple, sphere, anim")
-# Correct the output argument
-if args.output is None:
-    output = datetime.date.today().strftime("%Y%m%d")
-else:
-    output = args.output
-# Correct the path argument
-if args.path is not None:
-    path = f"{args.path}/" if args.path[-1] != "/" else args.path
-else:
-    path = ""
-# Combine the path with all files
-inputs = [
-    f"{path}{input_}" if input_.split(".")[-1] == "nc" else f"{path}{input_}.nc"
-    for input_ in args.input
-]
-for input_ in inputs:
-    if not glob.glob(input_):
-        print(f"I could not find {input_}")
-        print("Exiting...")
-        sys.exit()
-# Correct the savepath argument
-savepath = args.savepath if args.savepath is not None else ""
-savepath = path if savepath == "input" else savepath
-savepath = f"{savepath}/" if savepath != "" and savepath[-1] != "/" else savepath
-lat_1, lat_2, lon_1, lon_2 = args.latlon
-map_proj = args.map
-_VMIN = None if str(args.vrange[0]) == "None" else float(args.vrange[0])
-_VMAX = None if str(args.vrange[1]) == "None" else float(args.vrange[1])
-_FRAMERATE = args.framerate
-_TEX = args.tex
+parser.add_argument(
+    "--preview",
+    action="store_true",
+    help="Quick look: read the finest level of a coarsened copy of the input (built"
+    + " next to it the first time, see `cesm_helper_scripts.pyramid`) that fits"
+    + " --preview-size and --preview-frames. The time index of -t and --slice are"
+    + " given at full resolution.",
+)
+parser.add_argument(
+    "--preview-size",
+    default=360,
+    type=int,
+    help="Largest number of longitudes of the maps, or of time steps of the simple"
+    + " plot, with --preview.",
+)
+parser.add_argument(
+    "--preview-frames",
+    default=240,
+    type=int,
+    help="Largest number of frames of the animation with --preview.",
+)
+parser.add_argument(
+    "--workers",
+    default=4,
+    type=int,
+    help="Number of processes rendering the frames of the movie. The frames are"
+    + " streamed to ffmpeg in order, so no images are written to disk.",
+)
+parser.add_argument(
+    "--queue-size",
+    default=None,
+    type=int,
+    help="Largest number of frames rendered but not yet encoded, which bounds the"
+    + " memory used by the movie. Defaults to twice the number of workers.",
+)
+parser.add_argument(
+    "--profile",
+    type=str,
+    nargs="?",
+    const="cplt_profile.json",
+    default=None,
+    help="Save the time, CPU time, peak memory and bytes read and written of each"
+    + " stage to this JSON file (default: cplt_profile.json).",
+)
 
 
-def _file_exist(end):
+def _file_exist(savepath: str, output: str, end: str, yes: bool) -> None:
     """Check if output file exist."""
     if os.path.exists(savepath + output + end):
-        if not args.yes:
+        if not yes:
             ans = str(
                 input(
                     f"The file {output}{end} already exist in "
@@ -169,7 +159,7 @@ def _file_exist(end):
                 print("Exiting without making any plots...")
                 sys.exit()
     else:
-        if not args.yes:
+        if not yes:
             ans = str(input(f"Save to {savepath}{output}{end}? (y/n)\t"))
             if ans != "y":
                 print("Exiting without making any plots...")
@@ -180,157 +170,112 @@ def _file_exist(end):
     print("Saving to", savepath + output + end)
 
 
-if "simple" in args.plots:
-    _file_exist("_simple.png")
-if "sphere" in args.plots:
-    _file_exist("_sphere.png")
-if "anim" in args.plots:
-    _file_exist(".mp4")
-
-# === <CODE> ===
-__FIG_STD__ = cosmoplots.set_rcparams_dynamo(matplotlib.rcParams)
-
-
-def _latlon_over_time(
-    da: xr.DataArray, fig: plt.figure, time: int, *args, vmin=0, vmax=16, **kwargs
-):
-    __FIG_STD__[2] = 0.7
-    matplotlib.rcParams["text.usetex"] = _TEX
-    fig.subplots()
-    # ax = fig.add_axes(__FIG_STD__)
-    # the_map = Basemap(projection="moll", lon_0=0, lat_0=0, resolution="l")
-    the_map = Basemap(
-        projection=map_proj,
-        lon_0=0,
-        lat_0=0,
-        llcrnrlon=lon_1,
-        llcrnrlat=lat_1,
-        urcrnrlon=lon_2,
-        urcrnrlat=lat_2,
-        resolution="l",
-    )
-    the_map.drawcoastlines(linewidth=0.25)
-    the_map.drawmeridians(np.arange(0, 360, 30), linewidth=0.25)
-    the_map.drawparallels(np.arange(-90, 90, 30), linewidth=0.25)
-    x, y = np.meshgrid(da.isel(time=time).lon.data, da.isel(time=time).lat.data)
-    the_map.contourf(x, y, da.isel(time=time).data, latlon=True, vmin=vmin, vmax=vmax)
-    plt.title(da.time.data[time])
-    plt.colorbar()
-    return None, None
-
-
-def spherical_plot(da: xr.DataArray, ts: int, save="") -> None:
-    """Create an image of latxlon at a given time step."""
-    fig = plt.figure()
-    _latlon_over_time(da, fig, ts)
-    if save:
-        plt.savefig(save)
+def main():
+    """Run the main function."""
+    args = parser.parse_args()
+    if args.maps:
+        print(
+            "Find all available map projections at "
+            + "https://matplotlib.org/basemap/api/basemap_api.html#module-mpl_toolkits.basemap"
+        )
+        sys.exit(0)
+    # Correct the input argument
+    if args.input is None:
+        raise ValueError("you must give the input files")
+    if args.plots is None:
+        raise ValueError(
+            "you must specify what kind of plot you want (simple, sphere, anim)"
+        )
+    if not set(args.plots).issubset({"simple", "sphere", "anim"}):
+        raise ValueError("you must choose between: simple, sphere, anim")
+    # Correct the output argument
+    if args.output is None:
+        output = datetime.date.today().strftime("%Y%m%d")
     else:
-        plt.savefig(f"{savepath}{output}_sphere.png")
-    fig.clear()
-    plt.close()
-
-
-def xmov(da):
-    """Show animation of Model output.
-
-    Parameters
-    ----------
-    da: xr.DataArray
-        Model data
-    """
-    vmin = da.min().values if _VMIN is None else _VMIN
-    vmax = da.max().values * 0.8 if _VMAX is None else _VMAX
-    mov = Movie(da.chunk({"time": 1}), _latlon_over_time, vmin=vmin, vmax=vmax)
-    # FIXME: parallel gives several prompts
-    mov.save(
-        f"{savepath}{output}.mp4",
-        progress=True,
-        parallel=True,
-        parallel_compute_kwargs=dict(scheduler="processes", num_workers=4),
-        overwrite_existing=True,
-        remove_movie=False,
-        framerate=_FRAMERATE,
-        # verbose=True,
-    )
-
-
-def height_anim(da: xr.DataArray):
-    """Animate latitude versus height/pressure through time."""
-    if "lev" not in da.dims:
-        xmov(da)
-        return
-    vmin = np.nanmin(da.mean(dim="lon").values) if _VMIN is None else _VMIN
-    vmax = np.nanmax(da.mean(dim="lon").values) if _VMAX is None else _VMAX
-    plt.rcParams["image.cmap"] = "gist_ncar"
-    # Empirically estimated based on the below, where 1000 hPa ~ 0 km, 1e-2 ~ 80 km:
-    # https://www.cesm.ucar.edu/working_groups/Atmosphere/dycore-res/vertical-phase-1.html
-    hPa2km = 80 / 5 * (3 - np.log10(da.lev))
-    block = amp.blocks.Pcolormesh(
-        da.lat,
-        hPa2km,
-        da.mean(dim="lon").values,
-        norm=colors.LogNorm(vmin=vmin, vmax=vmax),
-    )
-    plt.colorbar(block.quad, pad=0.2)
-    plt.ylabel("km")
-    ax2 = plt.gca().twinx()
-    ax2.set_ylim(da.lev.max(), da.lev.min())
-    ax2.set_yscale("log")
-    ax2.set_ylabel("hPa")
-    plt.tight_layout()
-    time_float = cftime.date2num(da.time, "days since 0000-01-01") / 365
-    timeline = amp.Timeline(time_float, fps=10)
-    anim = amp.Animation([block], timeline)
-    anim.controls()
-    anim.save_gif(f"{savepath}{output}")
-    anim.save(f"{savepath}{output}.mp4")
+        output = args.output
+    # Correct the path argument
+    if args.path is not None:
+        path = f"{args.path}/" if args.path[-1] != "/" else args.path
+    else:
+        path = ""
+    # Combine the path with all files
+    inputs = [
+        (
+            f"{path}{input_}"
+            if input_.split(".")[-1] in ("nc", "zarr")
+            else f"{path}{input_}.nc"
+        )
+        for input_ in args.input
+    ]
+    # Zarr stores (e.g. `gen_agg --zarr`) are read chunk by chunk.
+    engine = "zarr" if all(i.endswith(".zarr") for i in inputs) else None
+    for input_ in inputs:
+        if not glob.glob(input_):
+            print(f"I could not find {input_}")
+            print("Exiting...")
+            sys.exit()
+    # Correct the savepath argument
+    savepath = args.savepath if args.savepath is not None else ""
+    savepath = path if savepath == "input" else savepath
+    savepath = f"{savepath}/" if savepath != "" and savepath[-1] != "/" else savepath
+    vrange = tuple(None if str(v) == "None" else float(v) for v in args.vrange)
+    map_kwargs = dict(projection=args.map, latlon=tuple(args.latlon), tex=args.tex)
 
+    if "simple" in args.plots:
+        _file_exist(savepath, output, "_simple.png", args.yes)
+    if "sphere" in args.plots:
+        _file_exist(savepath, output, "_sphere.png", args.yes)
+    if "anim" in args.plots:
+        _file_exist(savepath, output, ".mp4", args.yes)
 
-def attr_vs_time(da: xr.DataArray):
-    """Create a plot of the DataArray variable over time."""
-    # Compensate for the different width of grid cells at different latitudes.
-    # https://xarray.pydata.org/en/stable/examples/area_weighted_temperature.html
-    # Need mean = ( sum n*cos(lat) ) / ( sum cos(lat) )
-    fig = plt.figure()
-    _ = fig.add_axes(__FIG_STD__)
-    weights = np.cos(np.deg2rad(da.lat))
-    weights.name = "weights"
-    air_weighted = da.weighted(weights)
-    k_w = air_weighted.mean(("lon", "lat"))
-    k_w.plot()
-    plt.savefig(f"{savepath}{output}_simple.png")
-    plt.close()
+    with profiling.session(args.profile):
+        # Imported here, so that the arguments are checked before the data libraries
+        # are imported. The plotting backends are imported by the plots that use them.
+        with profiling.stage("import"):
+            from cesm_helper_scripts import plots
 
+        timestamp, slice_ = args.timestamp, args.slice
+        if args.preview:
+            from cesm_helper_scripts import pyramid
 
-# === </CODE> ===
-def main():
-    """Run the main function."""
-    multi_ds = xr.open_mfdataset(inputs, chunks="auto")
-    # It is assumed that the first variable is the only variable, and as such, the right
-    # variable.
-    try:
-        multi = getattr(multi_ds, list(multi_ds.data_vars)[0])
-    except Exception as e:
-        raise e
-    if args.slice is not None:
-        try:
-            multi = multi[
-                slice(
-                    *map(
-                        lambda x: int(x.strip()) if x.strip() else None,
-                        args.slice.split(":"),
-                    )
+            size = args.preview_size if {"sphere", "anim"} & set(args.plots) else None
+            frames = args.preview_frames if "anim" in args.plots else None
+            if frames is None and "simple" in args.plots:
+                frames = args.preview_size
+            inputs, factor = pyramid.select(inputs, size, frames)
+            # Every `factor`-th time step is kept in the preview.
+            timestamp //= factor
+            if slice_ is not None:
+                slice_ = ":".join(
+                    str(int(x) // factor) if x.strip() else ""
+                    for x in slice_.split(":")[:2]
+                )
+            print("Preview from", ", ".join(inputs))
+        with profiling.stage("open"):
+            multi = plots.open_variable(inputs, engine, slice_)
+        with profiling.stage("reductions"):
+            plan = plots.reduction_plan(multi, args.plots, vrange)
+        if "simple" in args.plots:
+            with profiling.stage("simple"):
+                plots.attr_vs_time(multi, f"{savepath}{output}_simple.png", plan["k_w"])
+        if "sphere" in args.plots:
+            with profiling.stage("sphere"):
+                plots.spherical_plot(
+                    multi, timestamp, f"{savepath}{output}_sphere.png", **map_kwargs
+                )
+        if "anim" in args.plots:
+            with profiling.stage("anim"):
+                plots.height_anim(
+                    multi,
+                    f"{savepath}{output}",
+                    plan.get("zonal"),
+                    plan.get("data_range"),
+                    vrange,
+                    framerate=args.framerate,
+                    workers=args.workers,
+                    queue_size=args.queue_size,
+                    **map_kwargs,
                 )
-            ]
-        except Exception as e:
-            raise IndexError(f"Slicing failed. Tried with `da[{args.slice}]`.") from e
-    if "simple" in args.plots:
-        attr_vs_time(multi)
-    if "sphere" in args.plots:
-        spherical_plot(multi, args.timestamp)
-    if "anim" in args.plots:
-        height_anim(multi)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,264 @@
+"""Render lat/lon map frames and stream them to ffmpeg.
+
+`MapFrames` draws the map background (projection, coastlines, meridians and
+parallels) once, and then only the data of each frame. `write_movie` renders the
+frames in a pool of worker processes, each with its own `MapFrames`, and pipes the
+raw RGB images in time order to one `ffmpeg` process, so no images are written to
+disk. At most `queue_size` frames are in flight at any time, which bounds the memory
+used.
+"""
+
+import collections
+import functools
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Optional, Tuple
+
+import matplotlib
+import numpy as np
+import xarray as xr
+
+LatLon = Tuple[Optional[float], Optional[float], Optional[float], Optional[float]]
+
+
+@functools.lru_cache(maxsize=None)
+def _basemap(projection, llcrnrlat, urcrnrlat, llcrnrlon, urcrnrlon):
+    from mpl_toolkits.basemap import Basemap
+
+    # Setting up the projection and reading the coastlines is the slow part of a map,
+    # and is the same for every frame.
+    return Basemap(
+        projection=projection,
+        lon_0=0,
+        lat_0=0,
+        llcrnrlon=llcrnrlon,
+        llcrnrlat=llcrnrlat,
+        urcrnrlon=urcrnrlon,
+        urcrnrlat=urcrnrlat,
+        resolution="l",
+    )
+
+
+class MapFrames:
+    """Draw lat/lon maps of one grid, with the background drawn only once.
+
+    The projection, the coastlines, the meridians and parallels and the coordinate mesh
+    are made once. Each frame then only replaces the filled contours, the title and
+    the colorbar, which gives the same image as drawing the whole map again.
+
+    Parameters
+    ----------
+    lon : np.ndarray
+        The longitudes of the grid.
+    lat : np.ndarray
+        The latitudes of the grid.
+    fig : Optional[matplotlib.figure.Figure]
+        The figure to draw in. A new figure is made if not given.
+    vmin : float
+        Lower limit of the colour scale.
+    vmax : float
+        Upper limit of the colour scale.
+    projection : str
+        The Basemap projection.
+    latlon : LatLon
+        Latitude (low, high) and longitude (low, high) of the map.
+    tex : bool
+        Use tex/latex fonts.
+    """
+
+    def __init__(
+        self,
+        lon,
+        lat,
+        fig=None,
+        vmin=0,
+        vmax=16,
+        projection: str = "cyl",
+        latlon: LatLon = (None, None, None, None),
+        tex: bool = False,
+    ) -> None:
+        import matplotlib.pyplot as plt
+
+        matplotlib.rcParams["text.usetex"] = tex
+        self.fig = plt.figure() if fig is None else fig
+        self.ax = self.fig.subplots()
+        # ax = fig.add_axes(__FIG_STD__)
+        # the_map = Basemap(projection="moll", lon_0=0, lat_0=0, resolution="l")
+        self.map = _basemap(projection, *latlon)
+        self.map.drawcoastlines(linewidth=0.25, ax=self.ax)
+        self.map.drawmeridians(np.arange(0, 360, 30), linewidth=0.25, ax=self.ax)
+        self.map.drawparallels(np.arange(-90, 90, 30), linewidth=0.25, ax=self.ax)
+        self.x, self.y = np.meshgrid(np.asarray(lon), np.asarray(lat))
+        self.vmin, self.vmax = vmin, vmax
+        self._contours = None
+        self._cax = None
+
+    def draw(self, data, title):
+        """Draw one frame.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            The data on the (lat, lon) grid.
+        title : Any
+            The title of the frame, e.g. the time.
+
+        Returns
+        -------
+        matplotlib.figure.Figure
+            The figure.
+        """
+        if self._contours is not None:
+            self._contours.remove()
+        self._contours = self.map.contourf(
+            self.x,
+            self.y,
+            data,
+            latlon=True,
+            vmin=self.vmin,
+            vmax=self.vmax,
+            ax=self.ax,
+        )
+        self.ax.set_title(title)
+        if self._cax is None:
+            self._cax = self.fig.colorbar(self._contours, ax=self.ax).ax
+        else:
+            # Reusing the axes keeps the map from shrinking for every new colorbar.
+            self._cax.clear()
+            self.fig.colorbar(self._contours, cax=self._cax)
+        return self.fig
+
+    def rgb(self, data, title) -> np.ndarray:
+        """Draw one frame and return it as an RGB image with shape (height, width, 3)."""
+        fig = self.draw(data, title)
+        fig.canvas.draw()
+        return np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+
+
+# The `MapFrames` of each worker process, made by `_init_worker`.
+_FRAMES: Optional[MapFrames] = None
+
+
+def _init_worker(rcparams: dict, kwargs: dict) -> None:
+    global _FRAMES
+    matplotlib.use("Agg")
+    matplotlib.rcParams.update(rcparams)
+    _FRAMES = MapFrames(**kwargs)
+
+
+def _render(data: np.ndarray, title: Any) -> Tuple[Tuple[int, int], bytes]:
+    if _FRAMES is None:
+        raise RuntimeError(
+            "the worker was not set up to render frames, see _init_worker"
+        )
+    image = _FRAMES.rgb(data, title)
+    return image.shape[:2], image.tobytes()
+
+
+def _ffmpeg(out: str, width: int, height: int, framerate: int) -> subprocess.Popen:
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise FileNotFoundError("ffmpeg is needed to make movies, but was not found")
+    # `-y` overwrites the output, so ffmpeg never asks anything.
+    cmd = [ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24"]
+    cmd += ["-s", f"{width}x{height}", "-r", str(framerate), "-i", "-"]
+    # libx264 with yuv420p needs an even width and height.
+    cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-vcodec", "libx264"]
+    cmd += ["-pix_fmt", "yuv420p", out]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def _close(ffmpeg: subprocess.Popen, out: str) -> None:
+    try:
+        ffmpeg.stdin.close()
+    except BrokenPipeError:
+        pass
+    # With `-loglevel error` the output is short, so it is only read at the end.
+    error = ffmpeg.stderr.read().decode(errors="replace").strip()
+    if ffmpeg.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed to write {out}: {error}")
+
+
+def write_movie(
+    da: xr.DataArray,
+    out: str,
+    workers: int = 4,
+    framerate: int = 5,
+    queue_size: Optional[int] = None,
+    progress: bool = True,
+    **kwargs,
+) -> None:
+    """Render a lat/lon map of each time step, and encode them to a movie.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The data, with `time`, `lat` and `lon` dimensions. Read one time step at a
+        time.
+    out : str
+        The movie file, e.g. `.mp4`.
+    workers : int
+        Number of processes rendering frames.
+    framerate : int
+        Frames per second.
+    queue_size : Optional[int]
+        Largest number of frames that are read or rendered, but not yet encoded.
+        Defaults to twice the number of workers.
+    progress : bool
+        Print the progress.
+    **kwargs
+        Keyword arguments passed on to `MapFrames`, e.g. `vmin`, `vmax`,
+        `projection`, `latlon` and `tex`.
+
+    Raises
+    ------
+    RuntimeError
+        If ffmpeg fails.
+    """
+    da = da.chunk({"time": 1}) if da.chunks is not None else da
+    kwargs.update(lon=da.lon.values, lat=da.lat.values)
+    rcparams = {k: v for k, v in matplotlib.rcParams.items() if k != "backend"}
+    queue_size = queue_size or 2 * workers
+    nframes = da.sizes["time"]
+    pending: collections.deque = collections.deque()
+    ffmpeg: Optional[subprocess.Popen] = None
+    written = 0
+
+    def _write(future) -> None:
+        nonlocal ffmpeg, written
+        (height, width), image = future.result()
+        if ffmpeg is None:
+            ffmpeg = _ffmpeg(out, width, height, framerate)
+        try:
+            ffmpeg.stdin.write(image)
+        except BrokenPipeError:
+            # ffmpeg has exited, and its error output tells why.
+            process, ffmpeg = ffmpeg, None
+            _close(process, out)
+            raise RuntimeError(
+                f"ffmpeg stopped before all frames of {out} were written"
+            )
+        written += 1
+        if progress:
+            print(f"\rEncoded {written}/{nframes} frames", end="", flush=True)
+
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(rcparams, kwargs)
+    ) as pool:
+        try:
+            for i in range(nframes):
+                frame = da.isel(time=i)
+                pending.append(pool.submit(_render, frame.values, frame.time.item()))
+                # The oldest frame is always written first, which keeps the order.
+                if len(pending) >= queue_size:
+                    _write(pending.popleft())
+            while pending:
+                _write(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+            if ffmpeg is not None:
+                _close(ffmpeg, out)
+    if progress:
+        print()
@@ -0,0 +1,264 @@
+"""Keep a sidecar index of the headers of CESM history files.
+
+The index is a JSON file stored next to the history files. For every file it records
+the variables, the dimensions, a checksum of the grid, the time values, bounds and
+calendar, together with the modification time and size of the file. An entry is only
+read again from the netCDF file when the modification time or the size has changed, so
+validating attributes or listing the variables of a long run does not touch the data.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import cftime
+import netCDF4
+import numpy as np
+
+INDEX_NAME = ".cesm_history_index.json"
+_VERSION = 2
+# Below this many files the headers are read in this process.
+_PARALLEL_FROM = 32
+
+
+def _read_header(file: str) -> Dict:
+    """Read the metadata of one history file.
+
+    Parameters
+    ----------
+    file : str
+        Path to the netCDF file.
+
+    Returns
+    -------
+    Dict
+        The header information of the file.
+    """
+    with netCDF4.Dataset(file, "r") as ds:
+        variables = {}
+        for name, var in ds.variables.items():
+            variables[name] = {
+                "dims": list(var.dimensions),
+                "long_name": getattr(var, "long_name", ""),
+                "units": getattr(var, "units", ""),
+            }
+        entry: Dict = {
+            "dims": {name: len(dim) for name, dim in ds.dimensions.items()},
+            "variables": variables,
+            "time": [],
+            "units": None,
+            "calendar": None,
+        }
+        # A checksum of the coordinates that are not time, to tell whether files are
+        # on the same grid without reading the coordinates again.
+        grid = hashlib.sha1()
+        for name in sorted(ds.dimensions):
+            if name != "time" and name in ds.variables:
+                values = np.ma.getdata(ds.variables[name][:])
+                grid.update(name.encode() + np.ascontiguousarray(values).tobytes())
+        entry["grid"] = grid.hexdigest()
+        if "time" in ds.variables:
+            time = ds.variables["time"]
+            entry["time"] = np.asarray(time[:], dtype=float).tolist()
+            entry["units"] = getattr(time, "units", None)
+            entry["calendar"] = getattr(time, "calendar", "standard")
+            bounds = getattr(time, "bounds", None)
+            if bounds in ds.variables:
+                entry["bounds"] = np.asarray(ds.variables[bounds][:], float).tolist()
+    return entry
+
+
+class HistoryIndex:
+    """Index of the history files found in one directory.
+
+    Parameters
+    ----------
+    directory : str
+        The directory the history files (and the index) live in.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory or "."
+        self.file = os.path.join(self.directory, INDEX_NAME)
+        self.entries: Dict[str, Dict] = {}
+        self._changed = False
+        if os.path.exists(self.file):
+            try:
+                with open(self.file) as f:
+                    content = json.load(f)
+            except (OSError, ValueError):
+                content = {}
+            if content.get("version") == _VERSION:
+                self.entries = content.get("files", {})
+
+    def update(self, files: List[str], workers: Optional[int] = None) -> None:
+        """Make sure the entries of `files` are up to date.
+
+        Parameters
+        ----------
+        files : List[str]
+            Paths to history files inside the index directory.
+        workers : Optional[int]
+            Number of processes used to read the headers of new or changed files.
+            Defaults to the number of CPUs when there are many files to read.
+        """
+        stale = {}
+        for file in files:
+            key = os.path.basename(file)
+            stat = os.stat(file)
+            entry = self.entries.get(key)
+            if (
+                entry is None
+                or entry["mtime"] != stat.st_mtime
+                or entry["size"] != stat.st_size
+            ):
+                stale[file] = stat
+        if not stale:
+            return
+        if workers is None:
+            workers = os.cpu_count() if len(stale) > _PARALLEL_FROM else 1
+        if workers > 1:
+            with ProcessPoolExecutor(workers) as pool:
+                headers = list(pool.map(_read_header, stale, chunksize=16))
+        else:
+            headers = [_read_header(file) for file in stale]
+        for (file, stat), entry in zip(stale.items(), headers):
+            entry["mtime"] = stat.st_mtime
+            entry["size"] = stat.st_size
+            self.entries[os.path.basename(file)] = entry
+        self._changed = True
+
+    def save(self) -> None:
+        """Write the index to disk if anything has changed."""
+        if not self._changed:
+            return
+        # Write to a temporary file first, since several processes (e.g. the tasks of
+        # a job array) may save the same index at the same time.
+        tmp = f"{self.file}.{os.getpid()}"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"version": _VERSION, "files": self.entries}, f)
+            os.replace(tmp, self.file)
+        except OSError as e:
+            print(f"Could not save the index file {self.file}: {e}")
+        else:
+            self._changed = False
+
+    def entry(self, file: str) -> Dict:
+        """Return the index entry of a file."""
+        return self.entries[os.path.basename(file)]
+
+
+class FileIndex:
+    """Header information of a list of history files, backed by `HistoryIndex`.
+
+    Parameters
+    ----------
+    files : List[str]
+        Paths to the history files. Files in different directories are indexed in
+        the respective directories.
+    workers : Optional[int]
+        Number of processes used to read headers, see `HistoryIndex.update`.
+    """
+
+    def __init__(self, files: List[str], workers: Optional[int] = None) -> None:
+        self.files = sorted(files)
+        self._indexes: Dict[str, HistoryIndex] = {}
+        for file in self.files:
+            directory = os.path.dirname(file)
+            if directory not in self._indexes:
+                self._indexes[directory] = HistoryIndex(directory)
+        for directory, index in self._indexes.items():
+            in_dir = [f for f in self.files if os.path.dirname(f) == directory]
+            index.update(in_dir, workers)
+            index.save()
+
+    def entry(self, file: str) -> Dict:
+        """Return the index entry of a file."""
+        return self._indexes[os.path.dirname(file)].entry(file)
+
+    def variables(self) -> Dict[str, Dict]:
+        """Return the variables found in all files, with long name and units.
+
+        Returns
+        -------
+        Dict[str, Dict]
+            Variable names mapped to their header information in the first file.
+        """
+        common: Optional[Dict[str, Dict]] = None
+        for file in self.files:
+            variables = self.entry(file)["variables"]
+            if common is None:
+                common = dict(variables)
+            else:
+                common = {k: v for k, v in common.items() if k in variables}
+        return common or {}
+
+    def missing(self, attr: str) -> List[str]:
+        """Return the files that do not contain the variable `attr`."""
+        return [f for f in self.files if attr not in self.entry(f)["variables"]]
+
+    def times(self, file: str) -> np.ndarray:
+        """Return the time values of a file as `cftime` dates."""
+        entry = self.entry(file)
+        if not entry["time"] or entry["units"] is None:
+            return np.array([])
+        return cftime.num2date(entry["time"], entry["units"], entry["calendar"])
+
+    def _days(self, file: str) -> np.ndarray:
+        # All files are put on the same reference date, so that files with different
+        # time units can be compared.
+        dates = self.times(file)
+        if not len(dates):
+            return np.array([])
+        return np.asarray(
+            cftime.date2num(
+                dates, "days since 0001-01-01", calendar=self.entry(file)["calendar"]
+            ),
+            dtype=float,
+        )
+
+    def time_span(self, file: str) -> Optional[Tuple[float, float]]:
+        """Return the first and last time of a file, in days since 0001-01-01."""
+        days = self._days(file)
+        if not len(days):
+            return None
+        return float(np.min(days)), float(np.max(days))
+
+    def time_problems(self) -> List[str]:
+        """Look for gaps and overlaps in time between consecutive files.
+
+        Returns
+        -------
+        List[str]
+            Human readable descriptions of the problems found.
+        """
+        spans = [(s, f) for f in self.files if (s := self.time_span(f)) is not None]
+        spans.sort()
+        problems = []
+        calendars = {self.entry(f)["calendar"] for _, f in spans}
+        if len(calendars) > 1:
+            problems.append(f"The files use different calendars: {sorted(calendars)}")
+        if len(spans) < 2:
+            return problems
+        # The expected distance between two consecutive time steps. Use the steps
+        # inside the files if there are any, otherwise the distance between files.
+        inner = [np.diff(d) for f in self.files if len(d := self._days(f)) > 1]
+        if inner:
+            step = float(np.median(np.concatenate(inner)))
+        else:
+            step = float(np.median(np.diff([s[0] for s, _ in spans])))
+        for (prev, prev_file), (this, this_file) in zip(spans[:-1], spans[1:]):
+            if this[0] <= prev[1]:
+                problems.append(
+                    f"{os.path.basename(this_file)} overlaps in time with"
+                    f" {os.path.basename(prev_file)}"
+                )
+            elif this[0] - prev[1] > 1.5 * step:
+                problems.append(
+                    f"Gap of {this[0] - prev[1]:.0f} days between"
+                    f" {os.path.basename(prev_file)} and {os.path.basename(this_file)}"
+                )
+        return problems
@@ -0,0 +1,183 @@
+"""Global and hemispheric land ice volume from land history files.
+
+The volume is the ice thickness times the cell area, summed over the grid. The cell
+areas are taken from the `area` variable of the land output (in km^2, times `landfrac`
+if present), or else computed on the sphere from the lat/lon grid. The three sums
+(global, northern and southern hemisphere) are one contraction of each time chunk with
+a stack of area matrices, so the files are read once and only one chunk per thread is
+held in memory.
+
+Example:
+    from cesm_helper_scripts import ice_volume
+    out = ice_volume.run(files, "thk", "run_ice_volume.nc", max_memory="2GB")
+    ice_volume.plot(out, "run_simple.png")
+"""
+
+from typing import List, Optional
+
+import dask
+import numpy as np
+import xarray as xr
+
+from cesm_helper_scripts import aggregate, concat
+
+EARTH_RADIUS = 6.37122e6  # m, as in CESM
+REGIONS = ("global", "nh", "sh")
+
+
+def _edges(centers: np.ndarray, low: float, high: float) -> np.ndarray:
+    mid = (centers[1:] + centers[:-1]) / 2
+    first = centers[0] - (mid[0] - centers[0]) if len(mid) else low
+    last = centers[-1] + (centers[-1] - mid[-1]) if len(mid) else high
+    return np.clip(np.concatenate([[first], mid, [last]]), low, high)
+
+
+def cell_area(ds: xr.Dataset) -> xr.DataArray:
+    """Return the land area of each grid cell in m^2.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Land output with `lat` and `lon`, and optionally `area` and `landfrac`.
+
+    Returns
+    -------
+    xr.DataArray
+        The areas with dimensions (lat, lon).
+    """
+    if "area" in ds:
+        area = ds["area"].fillna(0).astype("f8")
+        units = area.attrs.get("units", "km^2").replace("^", "").replace("**", "")
+        if units in ("km2", "km 2"):
+            area = area * 1e6
+    else:
+        lat = np.deg2rad(_edges(ds.lat.values, -90, 90))
+        lon = np.deg2rad(_edges(ds.lon.values, -360, 720))
+        area = xr.DataArray(
+            EARTH_RADIUS**2 * np.diff(np.sin(lat))[:, None] * np.diff(lon)[None, :],
+            dims=("lat", "lon"),
+            coords={"lat": ds.lat, "lon": ds.lon},
+        )
+    if "landfrac" in ds:
+        area = area * ds["landfrac"].fillna(0)
+    area = area.isel({d: 0 for d in area.dims if d not in ("lat", "lon")})
+    return area.transpose("lat", "lon").compute()
+
+
+def _contract(block: np.ndarray, w: np.ndarray) -> np.ndarray:
+    # Missing values (e.g. over the ocean) do not add to the volume.
+    return np.tensordot(np.where(np.isnan(block), 0, block), w, axes=([-2, -1], [1, 2]))
+
+
+def volume(da: xr.DataArray, area: xr.DataArray) -> xr.Dataset:
+    """Compute the global and hemispheric ice volume.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Ice thickness with `lat` and `lon` dimensions.
+    area : xr.DataArray
+        The cell areas, see `cell_area`.
+
+    Returns
+    -------
+    xr.Dataset
+        `volume_global`, `volume_nh` and `volume_sh`, lazy if `da` is a dask array.
+    """
+    lat = area.lat.values[:, None]
+    a = area.values
+    w = np.stack([a, np.where(lat >= 0, a, 0), np.where(lat < 0, a, 0)])
+    if da.chunks is not None:
+        da = da.chunk({"lat": -1, "lon": -1})
+    out = xr.apply_ufunc(
+        _contract,
+        da.reset_coords(drop=True),
+        input_core_dims=[["lat", "lon"]],
+        output_core_dims=[["region"]],
+        kwargs={"w": w},
+        dask="parallelized",
+        output_dtypes=["f8"],
+        dask_gufunc_kwargs={"output_sizes": {"region": len(REGIONS)}},
+    )
+    units = da.attrs.get("units", "")
+    units = "m3" if units == "m" else f"{units} m2".strip()
+    ds = xr.Dataset()
+    for i, region in enumerate(REGIONS):
+        ds[f"volume_{region}"] = out.isel(region=i).assign_attrs(
+            long_name=f"{region} volume of {da.attrs.get('long_name', da.name)}",
+            units=units,
+        )
+    return ds
+
+
+def run(
+    files: List[str],
+    variable: Optional[str],
+    out: str,
+    max_memory: str = "1GB",
+) -> str:
+    """Write the ice volume series of many land history files.
+
+    Parameters
+    ----------
+    files : List[str]
+        The history files.
+    variable : Optional[str]
+        The ice thickness. If None, the only variable over (time, lat, lon) is used.
+    out : str
+        The output `.nc` file.
+    max_memory : str
+        Bound on the memory used by the data, e.g. `"4GB"`. Sets the number of time
+        steps in each chunk.
+
+    Returns
+    -------
+    str
+        The output file.
+
+    Raises
+    ------
+    ValueError
+        If `variable` is not given and cannot be found.
+    """
+    ds = concat.open_history(files)
+    if variable is None:
+        found = [v for v in ds.data_vars if set(ds[v].dims) == {"time", "lat", "lon"}]
+        if len(found) != 1:
+            raise ValueError(f"give the ice thickness variable, one of {found}")
+        variable = found[0]
+    steps = aggregate.time_chunk_for_memory(ds, [variable], max_memory)
+    da = ds[variable].chunk({"time": steps})
+    series = volume(da, cell_area(ds))
+    series.attrs = {"source_variable": variable, "source_files": len(files)}
+    with dask.config.set(scheduler="threads"):
+        series.to_netcdf(out)
+    ds.close()
+    return out
+
+
+def plot(filename: str, save: str) -> None:
+    """Plot the ice volume series written by `run`.
+
+    Parameters
+    ----------
+    filename : str
+        The output of `run`.
+    save : str
+        The image file.
+    """
+    import matplotlib.pyplot as plt
+
+    from cesm_helper_scripts.nc_to_np import decimal_years
+
+    with xr.open_dataset(filename) as ds:
+        years, _ = decimal_years(ds.time.data)
+        fig = plt.figure()
+        ax = fig.add_subplot()
+        for region in REGIONS:
+            ax.plot(years, ds[f"volume_{region}"].values, label=region)
+        ax.set_xlabel("Year")
+        ax.set_ylabel(f"Ice volume [{ds['volume_global'].attrs['units']}]")
+        ax.legend()
+    fig.savefig(save)
+    plt.close(fig)
@@ -5,19 +5,38 @@ npz-file.
 
 Usage:
     temp_nc_to_np -i single_file.nc -p up/three/layers -sp save_two_layers_below_input -o output_name
-"""
 
+With `--format npy`, the output is a directory of `.npy` files that is written chunk
+by chunk and can be opened with `npy_store.load`, memory-mapped.
+
+With `--batch`, each input file (or glob pattern) is converted to its own `.npz` file,
+named after the input, and outputs that are newer than their input are skipped:
+    nc2np --batch -i "*.nc" -sp npz --workers 4
+
+The conversion can also be used from python:
+    from cesm_helper_scripts.nc_to_np import convert, convert_many
+    convert(["T20210504.nc"], "T20210504.npz")
+"""
 
 import argparse
 import datetime
 import glob
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple, Union
 
 import cftime
+import dask
 import numpy as np
 import xarray as xr
 
+from cesm_helper_scripts import npy_store, profiling, weights
+
+FORMATS = ("npz", "npy")
+# The npy format is a directory, named after the output.
+EXTENSIONS = {"npz": ".npz", "npy": ""}
+
 parser = argparse.ArgumentParser(
     description="Create a numpy array of the attribute from a .nc file."
 )
@@ -37,7 +56,13 @@ parser.add_argument(
     + "the same path is used here as is for the path parameter. "
     + "If not given, the current directory is used.",
 )
-parser.add_argument("-i", "--input", type=str, nargs="+", help="Input .nc file(s).")
+parser.add_argument(
+    "-i",
+    "--input",
+    type=str,
+    nargs="+",
+    help='Input .nc file(s) or glob patterns, e.g. `"T*.nc"`.',
+)
 parser.add_argument("-o", "--output", help="Name of the output files.")
 parser.add_argument(
     "-y",
@@ -46,46 +71,330 @@ parser.add_argument(
     help="Answer yes to all questions.",
     action="store_true",
 )
+parser.add_argument(
+    "-v",
+    "--variables",
+    type=str,
+    nargs="+",
+    default=None,
+    help="The variables to convert. All variables are converted if not given, and"
+    + " saved under their names in the same file. A single variable is saved as"
+    + " 'data'.",
+)
+parser.add_argument(
+    "--format",
+    type=str,
+    default="npz",
+    choices=FORMATS,
+    help="Save to a .npz file, or to a directory of .npy files (npy) that is written"
+    + " chunk by chunk and can be memory-mapped when read.",
+)
+parser.add_argument(
+    "--gridded",
+    action="store_true",
+    help="Save the data on the lat/lon grid instead of the global mean. Needs"
+    + " --format npy.",
+)
+parser.add_argument(
+    "--batch",
+    action="store_true",
+    help="Convert each input file (glob patterns are expanded) to its own .npz file,"
+    + " named after the input. Outputs that are newer than their input are skipped,"
+    + " and no questions are asked.",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of worker processes used with --batch.",
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="Used with --batch, convert also the files that are up to date.",
+)
+parser.add_argument(
+    "--profile",
+    type=str,
+    nargs="?",
+    const="nc2np_profile.json",
+    default=None,
+    help="Save the time, CPU time, peak memory and bytes read and written of each"
+    + " stage to this JSON file (default: nc2np_profile.json).",
+)
+
+
+def decimal_years(time: np.ndarray) -> Tuple[np.ndarray, str]:
+    """Return the time in decimal years, on the calendar without leap years.
+
+    Parameters
+    ----------
+    time : np.ndarray
+        The time stamps, as cftime objects.
+
+    Returns
+    -------
+    Tuple[np.ndarray, str]
+        The decimal years, and the start of the first year, `t_0`.
+    """
+    shift = str(time[0])[:4]
+    t_0 = f"{shift}-01-01 00:00:00"
+    t = (
+        cftime.date2num(
+            time, f"days since {t_0}", calendar="noleap", has_year_zero=True
+        )
+        + float(shift) * 365
+    ) / 365
+    return t, t_0
+
+
+def nc_to_np(
+    temps: Union[xr.DataArray, xr.Dataset],
+    out: str,
+    fmt: str = "npz",
+    gridded: bool = False,
+) -> None:
+    """Convert the data in an xr.DataArray object to a numpy array, and save to .npz.
+
+    With a single variable the array is saved as `data`. The variables of a dataset
+    with several variables are saved under their own names, in the same archive and
+    computed together, so the input is only read once.
+
+    Parameters
+    ----------
+    temps : Union[xr.DataArray, xr.Dataset]
+        The data to be converted.
+    out : str
+        The output file, or directory with the `npy` format.
+    fmt : str
+        One of `FORMATS`. With `npy`, the arrays are written chunk by chunk to a
+        directory of `.npy` files, see `npy_store`.
+    gridded : bool
+        If True, the data is saved on the lat/lon grid instead of as a global mean.
+        Only used with the `npy` format.
+
+    Raises
+    ------
+    ValueError
+        If the format is not known, or if `gridded` is used with the `npz` format.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"the format must be one of {FORMATS}, not {fmt}")
+    if gridded and fmt != "npy":
+        raise ValueError("gridded output can only be saved in the npy format")
+    if isinstance(temps, xr.DataArray):
+        temps = temps.to_dataset()
+    series = {}
+    for name, da in temps.data_vars.items():
+        # Weighted by the cell areas, see `weights.grid_weights`. The weights are
+        # cached, so they are only computed once for all variables.
+        spatial = "lat" in da.dims and "lon" in da.dims
+        series[name] = weights.spatial_mean(da) if spatial and not gridded else da
+    names = ["data"] if len(series) == 1 else list(series)
+    t, t_0 = decimal_years(temps["time"].data)
+    lev = temps["lev"].values if "lev" in temps.coords else None
+    ilev = temps["ilev"].values if "ilev" in temps.coords else None
+    if fmt == "npz":
+        with profiling.stage("compute"):
+            values = dask.compute(*[k_w.data for k_w in series.values()])
+        arrays = dict(zip(names, values))
+        with profiling.stage("save"):
+            np.savez(out, **arrays, times=t, t_0=t_0, lev=lev, ilev=ilev)
+        return
+    arrays = dict(zip(names, [k_w.data for k_w in series.values()]))
+    arrays.update(times=t, lev=lev, ilev=ilev)
+    if gridded:
+        arrays.update(lat=temps.lat.values, lon=temps.lon.values)
+    variables = {
+        key: dict(
+            name=name,
+            dims=list(k_w.dims),
+            units=k_w.attrs.get("units"),
+            long_name=k_w.attrs.get("long_name"),
+        )
+        for key, (name, k_w) in zip(names, series.items())
+    }
+    meta = dict(t_0=t_0, variables=variables)
+    if len(series) == 1:
+        meta.update(variables["data"])
+    # The arrays are computed while they are written.
+    with profiling.stage("compute and save"):
+        npy_store.save(out, arrays, meta)
 
-args = parser.parse_args()
-# Correct the input argument
-if args.input is None:
-    raise ValueError("you must give the input files")
-# Correct the output argument
-if args.output is None:
-    output = datetime.date.today().strftime("%Y%m%d")
-else:
-    output = args.output
-# Correct the path argument
-if args.path is not None:
-    path = f"{args.path}/" if args.path[-1] != "/" else args.path
-else:
-    path = ""
-# Combine the path with all files
-inputs = [
-    f"{path}{input_}" if input_.split(".")[-1] == "nc" else f"{path}{input_}.nc"
-    for input_ in args.input
-]
-for input_ in inputs:
-    if not glob.glob(input_):
-        print(f"I could not find {input_}")
-        print("Exiting...")
-        sys.exit()
-# Correct the savepath argument
-savepath = args.savepath if args.savepath is not None else ""
-savepath = path if savepath == "input" else savepath
-savepath = f"{savepath}/" if savepath != "" and savepath[-1] != "/" else savepath
-
-# Check if output file exist
-
-
-def file_exist(end):
+
+def open_input(inputs: List[str], variables: Optional[List[str]] = None) -> xr.Dataset:
+    """Open the variables in the input files.
+
+    Parameters
+    ----------
+    inputs : List[str]
+        The input files, glob patterns or Zarr stores (e.g. from `gen_agg --zarr`).
+    variables : Optional[List[str]]
+        The variables to keep. All variables with a time dimension are kept if not
+        given.
+
+    Returns
+    -------
+    xr.Dataset
+        The variables, with the global attributes of the files.
+
+    Raises
+    ------
+    ValueError
+        If some of the variables are not found, or there are no variables.
+    """
+    # `xr.open_mfdataset` only expands a pattern given on its own, not in a list.
+    inputs = sorted({f for i in inputs for f in (glob.glob(i) or [i])})
+    # Zarr stores are read chunk by chunk.
+    engine = "zarr" if all(i.endswith(".zarr") for i in inputs) else None
+    # Variables without time (e.g. `gw`) are taken from the first file, instead of
+    # being stacked along time.
+    array_ds = xr.open_mfdataset(
+        inputs,
+        chunks="auto",
+        drop_variables="time_bnds",
+        engine=engine,
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+    )
+    # Cell areas and Gaussian weights are used as weights, not as data.
+    array_ds = array_ds.set_coords([w for w in ("area", "gw") if w in array_ds])
+    attr_list = [a for a in array_ds.data_vars if "time" in array_ds[a].dims]
+    if variables is not None:
+        missing = [v for v in variables if v not in array_ds.data_vars]
+        if missing:
+            raise ValueError(f"Could not find {missing}. Found {attr_list}")
+        attr_list = list(variables)
+    if not attr_list:
+        raise ValueError("The input files do not contain any variables over time.")
+    array = array_ds[attr_list]
+    array_ds.close()
+    return array
+
+
+def convert(
+    inputs: List[str],
+    out: str,
+    fmt: str = "npz",
+    gridded: bool = False,
+    variables: Optional[List[str]] = None,
+) -> str:
+    """Convert the input files to one .npz file (or `npy` directory).
+
+    Parameters
+    ----------
+    inputs : List[str]
+        The input files, see `open_input`.
+    out : str
+        The output file.
+    fmt : str
+        The output format, see `nc_to_np`.
+    gridded : bool
+        Save the data on the lat/lon grid, see `nc_to_np`.
+    variables : Optional[List[str]]
+        The variables to convert. All variables if not given.
+
+    Returns
+    -------
+    str
+        The output file.
+    """
+    with profiling.stage("open"):
+        data = open_input(inputs, variables)
+    with profiling.stage(f"convert {out}"):
+        nc_to_np(data, out, fmt, gridded)
+    return out
+
+
+def up_to_date(input_: str, out: str) -> bool:
+    """Check if the output file exists and is newer than the input file."""
+    if os.path.isdir(out):
+        # A store is complete when its metadata is written, which is done last.
+        if not npy_store.is_store(out):
+            return False
+        out = os.path.join(out, npy_store.META)
+    return os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(input_)
+
+
+def batch_output(input_: str, savepath: str, fmt: str = "npz") -> str:
+    """Return the output of `input_` in batch mode, `<savepath><stem><extension>`."""
+    stem = os.path.splitext(os.path.basename(os.path.normpath(input_)))[0]
+    return os.path.join(savepath, f"{stem}{EXTENSIONS[fmt]}")
+
+
+def convert_many(
+    inputs: List[str],
+    savepath: str = "",
+    workers: int = 1,
+    force: bool = False,
+    fmt: str = "npz",
+    gridded: bool = False,
+    variables: Optional[List[str]] = None,
+) -> List[str]:
+    """Convert each input file to its own .npz file.
+
+    Parameters
+    ----------
+    inputs : List[str]
+        The input files or glob patterns.
+    savepath : str
+        Directory of the output files, which are named after the inputs (see
+        `batch_output`).
+    workers : int
+        Number of worker processes.
+    force : bool
+        If True, the files are converted even if the output is up to date.
+    fmt : str
+        The output format, see `nc_to_np`.
+    gridded : bool
+        Save the data on the lat/lon grid, see `nc_to_np`.
+    variables : Optional[List[str]]
+        The variables to convert. All variables if not given.
+
+    Returns
+    -------
+    List[str]
+        The output files that were written.
+
+    Raises
+    ------
+    FileNotFoundError
+        If no input files are found.
+    """
+    files = sorted({f for i in inputs for f in (glob.glob(i) or [i])})
+    missing = [f for f in files if not os.path.exists(f)]
+    if missing or not files:
+        raise FileNotFoundError(f"Could not find the input files {missing or inputs}")
+    if savepath != "":
+        os.makedirs(savepath, exist_ok=True)
+    jobs = [(f, batch_output(f, savepath, fmt)) for f in files]
+    todo = [(f, out) for f, out in jobs if force or not up_to_date(f, out)]
+    if len(todo) < len(jobs):
+        print(f"Skipping {len(jobs) - len(todo)} files that are up to date.")
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(min(workers, len(todo))) as pool:
+            futures = [
+                pool.submit(convert, [f], out, fmt, gridded, variables)
+                for f, out in todo
+            ]
+            return [future.result() for future in futures]
+    return [convert([f], out, fmt, gridded, variables) for f, out in todo]
+
+
+def file_exist(savepath: str, output: str, end: str, yes: bool) -> None:
     """Check if the file exist and if it should be overwritten.
 
     Parameters
     ----------
+    savepath : str
+        The directory of the file.
+    output : str
+        The name of the file.
     end : str
         The file extension.
+    yes : bool
+        Answer yes to all questions.
     """
     if os.path.exists(savepath + output + end):
         ans = str(
@@ -100,7 +409,7 @@ def file_exist(end):
         else:
             print("Exiting without creating any file...")
             sys.exit()
-    elif not args.yes:
+    elif not yes:
         ans = str(input(f"Save to {savepath}{output}{end}? (y/n)\t"))
         if ans != "y":
             print("Exiting without creating any file...")
@@ -111,52 +420,66 @@ def file_exist(end):
         print("Saving to", savepath + output + end)
 
 
-file_exist(".npz")
-
-# Do some work
-
-
-def nc_to_np(temps: xr.Dataset):
-    """Convert the data in an xr.Datset object to a numpy array, and save to .npz.
-
-    Parameters
-    ----------
-    temps : xr.Dataset
-        The data to be converted.
-    """
-    # Compensate for the different width of grid cells at different latitudes.
-    # https://xarray.pydata.org/en/stable/examples/area_weighted_temperature.html
-    # Need mean = ( sum n*cos(lat) ) / ( sum cos(lat) )
-    weights = np.cos(np.deg2rad(temps.lat))
-    weights.name = "weights"
-    air_weighted = temps.weighted(weights)
-    k_w = air_weighted.mean(("lon", "lat"))
-    # Sets the time in decimal years. Calendar is without leap years.
-    shift = str(k_w["time"].data[0])[:4]
-    t_0 = f"{shift}-01-01 00:00:00"
-    t = (
-        cftime.date2num(
-            k_w["time"].data, f"days since {t_0}", calendar="noleap", has_year_zero=True
-        )
-        + float(shift) * 365
-    ) / 365
-    T = k_w.data
-    lev = getattr(k_w, "lev", None)
-    ilev = getattr(k_w, "ilev", None)
-    np.savez(f"{savepath}{output}.npz", data=T, times=t, t_0=t_0, lev=lev, ilev=ilev)
-
-
 def main():
     """Run the main function for the script."""
-    array_ds = xr.open_mfdataset(inputs, chunks="auto", drop_variables="time_bnds")
-    attr_list = list(array_ds.data_vars)
-    if len(attr_list) != 1:
-        raise ValueError(
-            "The input file must contain only one variable. " + f"Found {attr_list}"
+    args = parser.parse_args()
+    # Correct the input argument
+    if args.input is None:
+        raise ValueError("you must give the input files")
+    # Correct the output argument
+    if args.output is None:
+        output = datetime.date.today().strftime("%Y%m%d")
+    else:
+        output = args.output
+    # Correct the path argument
+    if args.path is not None:
+        path = f"{args.path}/" if args.path[-1] != "/" else args.path
+    else:
+        path = ""
+    # Combine the path with all files
+    inputs = [
+        (
+            f"{path}{input_}"
+            if input_.split(".")[-1] in ("nc", "zarr")
+            else f"{path}{input_}.nc"
+        )
+        for input_ in args.input
+    ]
+    for input_ in inputs:
+        if not glob.glob(input_):
+            print(f"I could not find {input_}")
+            print("Exiting...")
+            sys.exit()
+    # Correct the savepath argument
+    savepath = args.savepath if args.savepath is not None else ""
+    savepath = path if savepath == "input" else savepath
+    savepath = f"{savepath}/" if savepath != "" and savepath[-1] != "/" else savepath
+
+    if args.batch:
+        # With --workers, the stages of the worker processes are not recorded, only
+        # their CPU time.
+        with profiling.session(args.profile):
+            written = convert_many(
+                inputs,
+                savepath,
+                args.workers,
+                args.force,
+                args.format,
+                args.gridded,
+                args.variables,
+            )
+        print(f"Converted {len(written)} files.")
+        return
+    end = EXTENSIONS[args.format]
+    file_exist(savepath, output, end, args.yes)
+    with profiling.session(args.profile):
+        convert(
+            inputs,
+            f"{savepath}{output}{end}",
+            args.format,
+            args.gridded,
+            args.variables,
         )
-    array = getattr(array_ds, attr_list[0]).assign_attrs(array_ds.attrs)
-    array_ds.close()
-    nc_to_np(array)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+"""A directory of `.npy` files that can be written chunk by chunk and memory-mapped.
+
+A `.npz` archive has to be built in memory and is always read fully into memory, even
+with `np.load(..., mmap_mode="r")`. Here each array is its own `.npy` file in a
+directory, next to `meta.json` with the metadata (e.g. `t_0`, the dimensions and the
+units). Dask arrays are written one chunk at a time, and the arrays are opened lazily
+with `mmap_mode`:
+
+    from cesm_helper_scripts import npy_store
+    with npy_store.load("T20210504") as f:
+        times, data = f["times"], f["data"]
+"""
+
+import json
+import os
+from typing import Any, Dict, Iterator, Mapping, Optional
+
+import dask.array
+import numpy as np
+
+META = "meta.json"
+
+
+def is_store(path: str) -> bool:
+    """Check if `path` is a complete store (`meta.json` is written last)."""
+    return os.path.isfile(os.path.join(path, META))
+
+
+def save(path: str, arrays: Mapping[str, Any], meta: Optional[Dict] = None) -> str:
+    """Save arrays to a directory of `.npy` files.
+
+    Parameters
+    ----------
+    path : str
+        The directory. Created if it does not exist, and existing arrays are
+        overwritten.
+    arrays : Mapping[str, Any]
+        Arrays by name. Dask arrays are computed together and written one chunk at a
+        time. Entries that are None are left out.
+    meta : Optional[Dict]
+        Metadata that can be saved as JSON.
+
+    Returns
+    -------
+    str
+        The directory.
+    """
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, META)):
+        os.remove(os.path.join(path, META))
+    sources, targets = [], []
+    for name, array in arrays.items():
+        if array is None:
+            continue
+        file = os.path.join(path, f"{name}.npy")
+        if isinstance(array, dask.array.Array):
+            sources.append(array)
+            targets.append(
+                np.lib.format.open_memmap(file, "w+", array.dtype, array.shape)
+            )
+        else:
+            np.save(file, np.asarray(array))
+    # All dask arrays are stored together, so chunks they share are read once. Each
+    # chunk is written to its own part of the file.
+    dask.array.store(sources, targets, lock=False)
+    for out in targets:
+        out.flush()
+    del targets
+    names = [n for n, a in arrays.items() if a is not None]
+    with open(os.path.join(path, META), "w") as f:
+        json.dump({"arrays": names, **(meta or {})}, f, indent=1)
+    return path
+
+
+class NpyStore(Mapping):
+    """Read-only access to a store written by `save`, similar to `np.lib.npyio.NpzFile`.
+
+    Parameters
+    ----------
+    path : str
+        The directory.
+    mmap_mode : Optional[str]
+        Passed to `np.load`. With the default, `"r"`, the arrays are memory-mapped.
+
+    Raises
+    ------
+    FileNotFoundError
+        If `path` is not a complete store.
+    """
+
+    def __init__(self, path: str, mmap_mode: Optional[str] = "r") -> None:
+        if not is_store(path):
+            raise FileNotFoundError(f"Cannot find {META} in {path}.")
+        self.path = path
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(path, META)) as f:
+            self.meta: Dict = json.load(f)
+        self.files = list(self.meta["arrays"])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self.files:
+            if name in self.meta:
+                return np.asarray(self.meta[name])
+            raise KeyError(f"{name} is not in {self.path}")
+        return np.load(os.path.join(self.path, f"{name}.npy"), self.mmap_mode)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.files)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __enter__(self) -> "NpyStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Do nothing, the memory maps are closed when they are deleted."""
+
+
+def load(path: str, mmap_mode: Optional[str] = "r"):
+    """Open a `.npz` file, or a store written by `save`.
+
+    Parameters
+    ----------
+    path : str
+        The `.npz` file or the store directory.
+    mmap_mode : Optional[str]
+        Used to memory-map the arrays of a store. Ignored for `.npz` files.
+
+    Returns
+    -------
+    NpyStore | np.lib.npyio.NpzFile
+        A mapping from names to arrays, that can be used as a context manager.
+    """
+    if os.path.isdir(path):
+        return NpyStore(path, mmap_mode)
+    return np.load(path)
@@ -0,0 +1,215 @@
+"""Split an aggregation over several workers and merge the partial results.
+
+The history files, sorted by time, are split into contiguous groups. Each task
+aggregates one group into partial files named `<output>.partial-<task>-of-<ntasks>.nc`,
+and a merge step joins the partial files in time order into the final output. Time
+averages, splitting and compression are done in the merge. The
+tasks are run by a process pool, by a local `dask.distributed` cluster, or as the
+tasks of a SLURM job array (followed by a separate merge).
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+
+from cesm_helper_scripts import aggregate, concat, profiling
+from cesm_helper_scripts.history_index import FileIndex
+
+SCHEDULERS = ("processes", "distributed")
+
+
+def split_files(files: List[str], ntasks: int) -> List[List[str]]:
+    """Split the files into `ntasks` contiguous groups of about the same size.
+
+    Parameters
+    ----------
+    files : List[str]
+        Paths to the history files, sorted by time.
+    ntasks : int
+        Number of groups.
+
+    Returns
+    -------
+    List[List[str]]
+        The groups. Some groups are empty if there are fewer files than tasks.
+    """
+    return [list(g) for g in np.array_split(np.asarray(files, dtype=object), ntasks)]
+
+
+def partial_name(out: str, task: int, ntasks: int) -> str:
+    """Return the name of the partial file of task `task` (counted from 0)."""
+    base = out[:-3] if out.endswith(".nc") else out
+    return f"{base}.partial-{task:04d}-of-{ntasks:04d}.nc"
+
+
+def slurm_task() -> Tuple[int, int]:
+    """Return the task number (from 0) and the number of tasks of a SLURM job array.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The task number and the number of tasks.
+
+    Raises
+    ------
+    OSError
+        If not run inside a SLURM job array.
+    """
+    try:
+        task = int(os.environ["SLURM_ARRAY_TASK_ID"])
+        ntasks = int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+    except KeyError as e:
+        raise OSError("not running as a task of a SLURM job array") from e
+    return task - int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0)), ntasks
+
+
+def run_task(
+    index: FileIndex,
+    targets: Dict[str, str],
+    task: int,
+    ntasks: int,
+    fast: bool = True,
+    max_memory: Optional[str] = None,
+) -> List[str]:
+    """Aggregate the files of one task into partial files.
+
+    Parameters
+    ----------
+    index : FileIndex
+        Header index of all history files.
+    targets : Dict[str, str]
+        Mapping from variable name to the final output file.
+    task : int
+        The task number, counted from 0.
+    ntasks : int
+        The total number of tasks.
+    fast : bool
+        Whether to use the fast open path, see `concat.open_history`.
+    max_memory : Optional[str]
+        Cap on the memory used by the task, see `aggregate.write`.
+
+    Returns
+    -------
+    List[str]
+        The partial files that were written.
+    """
+    files = sorted(index.files, key=lambda f: index.time_span(f) or (np.inf, np.inf))
+    mine = split_files(files, ntasks)[task]
+    if not mine:
+        return []
+    with profiling.stage("open"):
+        dataset = concat.open_history(mine, index, fast)
+    # Keep the grid weights with the partial files, for the reductions in the merge.
+    dataset = dataset.set_coords([w for w in ("gw", "area") if w in dataset])
+    partials = {a: partial_name(out, task, ntasks) for a, out in targets.items()}
+    # Time averages need the full time series, and are done in the merge.
+    aggregate.write(dataset, partials, max_memory=max_memory, keep_weights=True)
+    dataset.close()
+    return list(partials.values())
+
+
+def merge(targets: Dict[str, str], ntasks: int, remove: bool = True, **kwargs) -> None:
+    """Join the partial files of all tasks into the final output files.
+
+    Parameters
+    ----------
+    targets : Dict[str, str]
+        Mapping from variable name to the final output file.
+    ntasks : int
+        The number of tasks the aggregation was split into.
+    remove : bool
+        If True, the partial files are deleted after the merge.
+    **kwargs
+        Keyword arguments passed on to `aggregate.write`, e.g. the time averages, part
+        size and compression of the final output.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the partial files of some tasks are missing.
+    """
+    partials = {}
+    for a, out in targets.items():
+        names = [partial_name(out, task, ntasks) for task in range(ntasks)]
+        found = [n for n in names if os.path.exists(n)]
+        if not found:
+            raise FileNotFoundError(f"Cannot find any partial files of {out}.")
+        # Tasks without any input files do not write anything, but those are always
+        # the last tasks.
+        if found != names[: len(found)]:
+            missing = sorted(set(names[: names.index(found[-1])]) - set(found))
+            raise FileNotFoundError(f"Missing partial files: {missing}")
+        partials[a] = found
+    for a, out in targets.items():
+        # The weights are the same in all partial files, and are taken from the first.
+        dataset = xr.open_mfdataset(
+            partials[a],
+            combine="nested",
+            concat_dim="time",
+            data_vars="minimal",
+            coords="minimal",
+            compat="override",
+        )
+        aggregate.write(dataset, {a: out}, **kwargs)
+        dataset.close()
+    if remove:
+        for found in partials.values():
+            for name in found:
+                os.remove(name)
+
+
+def run(
+    index: FileIndex,
+    targets: Dict[str, str],
+    workers: int,
+    scheduler: str = "processes",
+    fast: bool = True,
+    max_memory: Optional[str] = None,
+    **kwargs,
+) -> None:
+    """Aggregate with several workers, and merge the result.
+
+    Parameters
+    ----------
+    index : FileIndex
+        Header index of all history files.
+    targets : Dict[str, str]
+        Mapping from variable name to the final output file.
+    workers : int
+        Number of tasks, each run in its own worker process.
+    scheduler : str
+        `"processes"` uses a process pool, `"distributed"` a local
+        `dask.distributed` cluster.
+    fast : bool
+        Whether to use the fast open path, see `concat.open_history`.
+    max_memory : Optional[str]
+        Cap on the memory used by each task, see `aggregate.write`.
+    **kwargs
+        Keyword arguments passed on to `aggregate.write` in the merge step.
+
+    Raises
+    ------
+    ValueError
+        If the scheduler is not known.
+    """
+    tasks = [
+        (index, targets, task, workers, fast, max_memory) for task in range(workers)
+    ]
+    if scheduler == "processes":
+        # The CPU time of the worker processes is in `children_cpu_seconds`.
+        with profiling.stage("tasks"), ProcessPoolExecutor(workers) as pool:
+            for future in [pool.submit(run_task, *t) for t in tasks]:
+                future.result()
+    elif scheduler == "distributed":
+        from dask.distributed import Client, LocalCluster
+
+        with LocalCluster(n_workers=workers, threads_per_worker=1) as cluster:
+            with Client(cluster) as client, profiling.stage("tasks"):
+                client.gather([client.submit(run_task, *t) for t in tasks])
+    else:
+        raise ValueError(f"scheduler must be one of {SCHEDULERS}")
+    with profiling.stage("merge"):
+        merge(targets, workers, **kwargs)
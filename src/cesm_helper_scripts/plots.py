@@ -0,0 +1,297 @@
+"""Plots and animations of aggregated model output, used by `cplt`.
+
+The plotting backends (matplotlib, cosmoplots, animatplot, basemap, cftime) are only
+imported by the plots that need them, so importing this module is cheap:
+
+    from cesm_helper_scripts import plots
+    da = plots.open_variable(["T20210504.nc"])
+    plots.attr_vs_time(da, "T20210504_simple.png")
+    plots.spherical_plot(da, 0, "T20210504_sphere.png", projection="moll")
+"""
+
+import functools
+from typing import Any, Dict, List, Optional, Tuple
+
+import dask
+import numpy as np
+import xarray as xr
+
+from cesm_helper_scripts import weights
+
+VRange = Tuple[Optional[float], Optional[float]]
+
+
+@functools.lru_cache(maxsize=None)
+def _style() -> List[float]:
+    import cosmoplots
+    import matplotlib
+
+    # The axes position of the figures, which the map plots change.
+    return cosmoplots.set_rcparams_dynamo(matplotlib.rcParams)
+
+
+def open_variable(
+    inputs: List[str], engine: Optional[str] = None, slice_: Optional[str] = None
+) -> xr.DataArray:
+    """Open the first variable of one or more aggregated files.
+
+    Parameters
+    ----------
+    inputs : List[str]
+        The `.nc` files or `.zarr` stores.
+    engine : Optional[str]
+        Passed to `xr.open_mfdataset`, e.g. "zarr".
+    slice_ : Optional[str]
+        Slice of the DataArray, written as inside square brackets, e.g. "10:20".
+
+    Returns
+    -------
+    xr.DataArray
+        The variable, read lazily.
+
+    Raises
+    ------
+    IndexError
+        If the slicing fails.
+    """
+    # Variables without time (e.g. `gw`) are taken from the first file, instead of
+    # being stacked along time.
+    multi_ds = xr.open_mfdataset(
+        inputs,
+        chunks="auto",
+        engine=engine,
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+    )
+    # Cell areas and Gaussian weights are used as weights, not as data.
+    multi_ds = multi_ds.set_coords([w for w in ("area", "gw") if w in multi_ds])
+    # It is assumed that the first variable on the lat/lon grid is the only variable,
+    # and as such, the right variable. History files also have e.g. `time_bnds`.
+    names = list(multi_ds.data_vars)
+    gridded = [v for v in names if {"lat", "lon"} <= set(multi_ds[v].dims)]
+    multi = multi_ds[(gridded or names)[0]]
+    if slice_ is not None:
+        try:
+            multi = multi[
+                slice(
+                    *map(
+                        lambda x: int(x.strip()) if x.strip() else None,
+                        slice_.split(":"),
+                    )
+                )
+            ]
+        except Exception as e:
+            raise IndexError(f"Slicing failed. Tried with `da[{slice_}]`.") from e
+    return multi
+
+
+def spherical_plot(
+    da: xr.DataArray, ts: int, save: str, vmin=0, vmax=16, **kwargs
+) -> None:
+    """Create an image of latxlon at a given time step.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Model data
+    ts : int
+        The time index.
+    save : str
+        The image file.
+    vmin : float
+        Lower limit of the colour scale.
+    vmax : float
+        Upper limit of the colour scale.
+    **kwargs
+        Passed on to `frames.MapFrames`, e.g. `projection`, `latlon` and `tex`.
+    """
+    import matplotlib.pyplot as plt
+
+    from cesm_helper_scripts.frames import MapFrames
+
+    _style()[2] = 0.7
+    fig = plt.figure()
+    frame = da.isel(time=ts)
+    MapFrames(frame.lon.data, frame.lat.data, fig, vmin, vmax, **kwargs).draw(
+        frame.data, da.time.data[ts]
+    )
+    plt.savefig(save)
+    fig.clear()
+    plt.close()
+
+
+def xmov(
+    da: xr.DataArray,
+    save: str,
+    data_range=None,
+    vrange: VRange = (None, None),
+    framerate: int = 5,
+    workers: int = 4,
+    queue_size: Optional[int] = None,
+    **kwargs,
+) -> None:
+    """Show animation of Model output.
+
+    Parameters
+    ----------
+    da: xr.DataArray
+        Model data
+    save: str
+        The output, without the `.mp4` extension.
+    data_range: Optional[Tuple[xr.DataArray, xr.DataArray]]
+        The computed min and max of `da`, see `reduction_plan`. Computed here if not
+        given.
+    vrange: VRange
+        vmin and vmax. If None, the min and 0.8 times the max of the data is used.
+    framerate: int
+        Frames per second.
+    workers: int
+        Number of processes rendering the frames, see `frames.write_movie`.
+    queue_size: Optional[int]
+        Largest number of frames in memory, see `frames.write_movie`.
+    **kwargs
+        Passed on to `frames.MapFrames`, e.g. `projection`, `latlon` and `tex`.
+    """
+    from cesm_helper_scripts import frames
+
+    if data_range is None and None in vrange:
+        data_range = dask.compute(da.min(), da.max())
+    vmin = data_range[0].values if vrange[0] is None else vrange[0]
+    vmax = data_range[1].values * 0.8 if vrange[1] is None else vrange[1]
+    _style()[2] = 0.7
+    frames.write_movie(
+        da,
+        f"{save}.mp4",
+        workers=workers,
+        framerate=framerate,
+        queue_size=queue_size,
+        vmin=vmin,
+        vmax=vmax,
+        **kwargs,
+    )
+
+
+def height_anim(
+    da: xr.DataArray,
+    save: str,
+    zonal=None,
+    data_range=None,
+    vrange: VRange = (None, None),
+    **kwargs,
+) -> None:
+    """Animate latitude versus height/pressure through time.
+
+    The zonal mean (`zonal`) and, without a `lev` dimension, the min and max of the
+    data (`data_range`) are computed here if they are not given.
+
+    Parameters
+    ----------
+    da: xr.DataArray
+        Model data
+    save: str
+        The output, without the `.gif`/`.mp4` extension.
+    zonal: Optional[xr.DataArray]
+        The computed mean of `da` over longitude.
+    data_range: Optional[Tuple[xr.DataArray, xr.DataArray]]
+        The computed min and max of `da`, see `xmov`.
+    vrange: VRange
+        vmin and vmax. If None, the min and max of the zonal mean is used.
+    **kwargs
+        Passed on to `xmov` when `da` has no `lev` dimension.
+    """
+    if "lev" not in da.dims:
+        xmov(da, save, data_range, vrange, **kwargs)
+        return
+    import animatplot as amp
+    import cftime
+    import matplotlib.colors as colors
+    import matplotlib.pyplot as plt
+
+    _style()
+    zonal = da.mean(dim="lon").compute() if zonal is None else zonal
+    vmin = np.nanmin(zonal.values) if vrange[0] is None else vrange[0]
+    vmax = np.nanmax(zonal.values) if vrange[1] is None else vrange[1]
+    plt.rcParams["image.cmap"] = "gist_ncar"
+    # Empirically estimated based on the below, where 1000 hPa ~ 0 km, 1e-2 ~ 80 km:
+    # https://www.cesm.ucar.edu/working_groups/Atmosphere/dycore-res/vertical-phase-1.html
+    hPa2km = 80 / 5 * (3 - np.log10(da.lev))
+    block = amp.blocks.Pcolormesh(
+        da.lat,
+        hPa2km,
+        zonal.values,
+        norm=colors.LogNorm(vmin=vmin, vmax=vmax),
+    )
+    plt.colorbar(block.quad, pad=0.2)
+    plt.ylabel("km")
+    ax2 = plt.gca().twinx()
+    ax2.set_ylim(da.lev.max(), da.lev.min())
+    ax2.set_yscale("log")
+    ax2.set_ylabel("hPa")
+    plt.tight_layout()
+    time_float = cftime.date2num(da.time, "days since 0000-01-01") / 365
+    timeline = amp.Timeline(time_float, fps=10)
+    anim = amp.Animation([block], timeline)
+    anim.controls()
+    anim.save_gif(save)
+    anim.save(f"{save}.mp4")
+
+
+def attr_vs_time(da: xr.DataArray, save: str, k_w=None) -> None:
+    """Create a plot of the DataArray variable over time.
+
+    The global mean (`k_w`) is computed here if it is not given.
+
+    Parameters
+    ----------
+    da: xr.DataArray
+        Model data
+    save: str
+        The image file.
+    k_w: Optional[xr.DataArray]
+        The computed global mean of `da`.
+    """
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure()
+    _ = fig.add_axes(_style())
+    # Weighted by the cell areas, see `weights.grid_weights`.
+    k_w = weights.spatial_mean(da) if k_w is None else k_w
+    k_w.plot()
+    plt.savefig(save)
+    plt.close()
+
+
+def reduction_plan(
+    da: xr.DataArray, plots: List[str], vrange: VRange = (None, None)
+) -> Dict[str, Any]:
+    """Compute all reductions of `da` needed by `plots` in one pass over the data.
+
+    The reductions are put in one dask graph, so each chunk is read once even when
+    several plots are made. The results are kept for the renderers.
+
+    Parameters
+    ----------
+    da: xr.DataArray
+        Model data
+    plots: List[str]
+        The plots that will be made, any of simple, sphere and anim.
+    vrange: VRange
+        vmin and vmax of the animation. The min and max of the data are not computed if
+        both are given.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The keyword arguments of `attr_vs_time` (`k_w`, the global mean) and
+        `height_anim` (`zonal`, the zonal mean, or `data_range`, the min and max).
+    """
+    plan: Dict[str, Any] = {}
+    if "simple" in plots:
+        plan["k_w"] = weights.spatial_mean(da)
+    if "anim" in plots and "lev" in da.dims:
+        plan["zonal"] = da.mean(dim="lon")
+    elif "anim" in plots and None in vrange:
+        plan["data_range"] = (da.min(), da.max())
+    (computed,) = dask.compute(plan)
+    return computed
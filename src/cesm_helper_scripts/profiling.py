@@ -0,0 +1,206 @@
+"""Per-stage timing and memory use of the scripts, saved as a JSON report.
+
+The scripts mark their stages (e.g. opening the files, setting up the writes, the dask
+compute) with `stage`. When profiling is turned on with `--profile`, each stage records
+its wall and CPU time, the peak RSS, the bytes read and written by the process, and the
+dask tasks run in it, with the time spent in each kind of task (e.g. reading, `store`).
+When profiling is off, `stage` returns a shared no-op context manager, so the cost is one
+function call per stage.
+
+    from cesm_helper_scripts import profiling
+    profiling.enable("gen_agg_profile.json")
+    with profiling.stage("open"):
+        ...
+    profiling.write()
+"""
+
+import contextlib
+import importlib.util
+import json
+import os
+import sys
+import time
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None  # type: ignore
+
+# Largest number of dask tasks saved in the task stream of each stage.
+MAX_TASKS = 10000
+
+_NULL = contextlib.nullcontext()
+_REPORT: Optional[Dict] = None
+
+
+def enable(path: str) -> None:
+    """Turn on profiling, with the report saved to `path` by `write`."""
+    global _REPORT
+    _REPORT = {
+        "path": path,
+        "argv": sys.argv,
+        "pid": os.getpid(),
+        "start": time.time(),
+        "stages": [],
+        "_depth": 0,
+        "_t0": time.perf_counter(),
+    }
+
+
+def enabled() -> bool:
+    """Check if profiling is on."""
+    return _REPORT is not None
+
+
+def _io() -> Dict[str, int]:
+    # Bytes read and written by all threads of this process, including the page cache.
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return {"read": int(fields["rchar"]), "written": int(fields["wchar"])}
+    except (OSError, KeyError, ValueError):
+        if resource is None:
+            return {"read": 0, "written": 0}
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {"read": usage.ru_inblock * 512, "written": usage.ru_oublock * 512}
+
+
+def _usage() -> Dict[str, float]:
+    out = {"cpu": time.process_time(), "children_cpu": 0.0, "rss": 0.0}
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        out["children_cpu"] = children.ru_utime + children.ru_stime
+        # ru_maxrss is in kB on Linux, and in bytes on macOS.
+        scale = 1e6 if sys.platform == "darwin" else 1e3
+        out["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    return out
+
+
+def _summary(results: List, t0: float) -> Dict:
+    from dask.utils import key_split
+
+    by_prefix: Dict[str, float] = {}
+    for r in results:
+        prefix = key_split(r.key)
+        by_prefix[prefix] = by_prefix.get(prefix, 0.0) + r.end_time - r.start_time
+    stream = [
+        [key_split(r.key), r.start_time - t0, r.end_time - t0, r.worker_id]
+        for r in results[:MAX_TASKS]
+    ]
+    return {
+        "tasks": len(results),
+        "task_seconds": sum(by_prefix.values()),
+        "by_prefix": dict(sorted(by_prefix.items(), key=lambda kv: -kv[1])),
+        "task_stream": stream,
+    }
+
+
+@contextlib.contextmanager
+def _measure(name: str) -> Iterator[None]:
+    assert _REPORT is not None
+    record: Dict = {"name": name, "depth": _REPORT["_depth"]}
+    _REPORT["_depth"] += 1
+    io_0, usage_0 = _io(), _usage()
+    wall_0 = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        dask_profiler = None
+        if "dask" in sys.modules:
+            from dask.diagnostics import Profiler
+
+            dask_profiler = stack.enter_context(Profiler())
+        # The performance report of a dask.distributed client is drawn with bokeh.
+        if "distributed" in sys.modules and importlib.util.find_spec("bokeh"):
+            import distributed
+
+            try:
+                distributed.default_client()
+            except ValueError:
+                pass
+            else:
+                base = os.path.splitext(_REPORT["path"])[0]
+                report = f"{base}_{len(_REPORT['stages'])}_{name}.html"
+                stack.enter_context(distributed.performance_report(filename=report))
+                record["performance_report"] = report
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_0
+            io_1, usage_1 = _io(), _usage()
+            record.update(
+                start_seconds=wall_0 - _REPORT["_t0"],
+                wall_seconds=wall,
+                cpu_seconds=usage_1["cpu"] - usage_0["cpu"],
+                children_cpu_seconds=usage_1["children_cpu"] - usage_0["children_cpu"],
+                peak_rss_mb=usage_1["rss"],
+                read_bytes=io_1["read"] - io_0["read"],
+                written_bytes=io_1["written"] - io_0["written"],
+            )
+            if dask_profiler is not None and dask_profiler.results:
+                # The dask profiler uses `default_timer`, the same as `perf_counter`.
+                record["dask"] = _summary(dask_profiler.results, wall_0)
+            _REPORT["_depth"] -= 1
+            _REPORT["stages"].append(record)
+
+
+def stage(name: str):
+    """Measure a stage of a script, if profiling is on.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage in the report. Stages may be nested.
+
+    Returns
+    -------
+    ContextManager
+        Records the stage when it exits. A no-op if profiling is off.
+    """
+    if _REPORT is None:
+        return _NULL
+    return _measure(name)
+
+
+def write() -> Optional[str]:
+    """Save the report, if profiling is on.
+
+    Returns
+    -------
+    Optional[str]
+        The report file, or None if profiling is off.
+    """
+    if _REPORT is None:
+        return None
+    usage = _usage()
+    report = {k: v for k, v in _REPORT.items() if not k.startswith("_")}
+    report["stages"] = sorted(report["stages"], key=lambda s: s["start_seconds"])
+    report["total"] = {
+        "wall_seconds": time.perf_counter() - _REPORT["_t0"],
+        "cpu_seconds": usage["cpu"],
+        "children_cpu_seconds": usage["children_cpu"],
+        "peak_rss_mb": usage["rss"],
+    }
+    with open(_REPORT["path"], "w") as f:
+        json.dump(report, f, indent=1, default=str)
+    print("Saved the profile to", _REPORT["path"])
+    return _REPORT["path"]
+
+
+@contextlib.contextmanager
+def session(path: Optional[str]) -> Iterator[None]:
+    """Profile the code run inside, and save the report, if `path` is given.
+
+    Parameters
+    ----------
+    path : Optional[str]
+        The report file, e.g. from the `--profile` argument. Nothing is done if None.
+    """
+    if path is None:
+        yield
+        return
+    enable(path)
+    try:
+        with stage("total"):
+            yield
+    finally:
+        write()
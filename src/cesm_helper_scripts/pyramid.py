@@ -0,0 +1,167 @@
+"""Coarsened copies of an aggregated file, for quick-look plots.
+
+Level `k` of the pyramid has `2**k` by `2**k` grid cells averaged into one, and keeps
+every `2**k`-th time step. The levels are written to `<base>_pyramid/` next to the
+aggregated file (as `.nc` files or `.zarr` stores, the same as the input), with the
+index `pyramid.json` written last. All levels are made in one pass over the input, each
+from the level before it.
+
+`cplt --preview` reads the finest level that still fits the size of the plot and the
+number of frames:
+
+    from cesm_helper_scripts import pyramid
+    pyramid.build("T20210504.nc")
+    files, factor = pyramid.select(["T20210504.nc"], size=180, frames=120)
+"""
+
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import dask
+import xarray as xr
+
+INDEX = "pyramid.json"
+# The smallest number of grid cells along lat and lon of the coarsest level.
+MIN_CELLS = 4
+
+
+def directory(filename: str) -> str:
+    """Return the directory of the pyramid of `filename`."""
+    return f"{os.path.splitext(filename.rstrip('/'))[0]}_pyramid"
+
+
+def read_index(filename: str) -> Optional[Dict]:
+    """Return the index of the pyramid of `filename`.
+
+    None is returned if the pyramid is missing, or older than `filename`.
+    """
+    index = os.path.join(directory(filename), INDEX)
+    if not os.path.isfile(index) or os.path.getmtime(index) < os.path.getmtime(
+        filename
+    ):
+        return None
+    with open(index) as f:
+        return json.load(f)
+
+
+def coarsen(ds: xr.Dataset, factor: int) -> xr.Dataset:
+    """Average `factor` by `factor` grid cells, and keep every `factor`-th time step.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The data. Cell areas (`area`) and Gaussian weights (`gw`) are summed, so they
+        can still be used as weights.
+    factor : int
+        The coarsening factor.
+
+    Returns
+    -------
+    xr.Dataset
+        The coarsened data, lazy if `ds` is a dask dataset.
+    """
+    ds = ds.set_coords([w for w in ("area", "gw") if w in ds.data_vars])
+    if "time" in ds.dims:
+        ds = ds.isel(time=slice(None, None, factor))
+    dims = {d: factor for d in ("lat", "lon") if d in ds.dims}
+    sums = {w: "sum" for w in ("area", "gw") if w in ds.coords}
+    return ds.coarsen(dims, boundary="trim", coord_func=sums).mean(keep_attrs=True)
+
+
+def build(filename: str, levels: Optional[int] = None) -> Dict:
+    """Write the pyramid of an aggregated file.
+
+    Parameters
+    ----------
+    filename : str
+        The `.nc` file or `.zarr` store.
+    levels : Optional[int]
+        Number of coarsened levels. By default, levels are added until the grid has
+        fewer than `MIN_CELLS` cells along lat or lon.
+
+    Returns
+    -------
+    Dict
+        The index of the pyramid, see `read_index`.
+    """
+    zarr = filename.rstrip("/").endswith(".zarr")
+    ext = ".zarr" if zarr else ".nc"
+    path = directory(filename)
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, INDEX)):
+        os.remove(os.path.join(path, INDEX))
+    ds = xr.open_dataset(filename, chunks={}, engine="zarr" if zarr else None)
+    ds = ds[[v for v in ds.data_vars if ds[v].dtype.kind in "biuf"]]
+    entries = [{"file": None, "factor": 1, "sizes": dict(ds.sizes)}]
+    writes = []
+    level, factor = ds, 1
+    while levels is None or len(entries) <= levels:
+        if min(level.sizes.get(d, 0) for d in ("lat", "lon")) < 2 * MIN_CELLS:
+            break
+        # Each level is made from the one before, so the input is read once.
+        level, factor = coarsen(level, 2), 2 * factor
+        name = f"level_{len(entries)}{ext}"
+        out = os.path.join(path, name)
+        if zarr:
+            writes.append(level.to_zarr(out, mode="w", compute=False))
+        else:
+            writes.append(level.to_netcdf(out, compute=False))
+        entries.append({"file": name, "factor": factor, "sizes": dict(level.sizes)})
+    with dask.config.set(scheduler="threads"):
+        dask.compute(*writes)
+    ds.close()
+    index = {"source": os.path.basename(filename.rstrip("/")), "levels": entries}
+    with open(os.path.join(path, INDEX), "w") as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def select(
+    inputs: List[str], size: Optional[int] = None, frames: Optional[int] = None
+) -> Tuple[List[str], int]:
+    """Pick the finest pyramid level that fits the plot, building pyramids if needed.
+
+    Parameters
+    ----------
+    inputs : List[str]
+        The aggregated files, with the same grid.
+    size : Optional[int]
+        Largest number of grid cells along longitude, e.g. the width of the map in
+        pixels. Not checked if None.
+    frames : Optional[int]
+        Largest number of time steps in total over all `inputs`, e.g. the number of
+        frames in a movie or the width of a time series. Not checked if None.
+
+    Returns
+    -------
+    Tuple[List[str], int]
+        The file of the chosen level for each input, and its coarsening factor. The
+        coarsest level is used if none of them fits.
+    """
+    indexes = []
+    for input_ in inputs:
+        index = read_index(input_)
+        if index is None:
+            print(f"Building the preview pyramid of {input_}")
+            index = build(input_)
+        indexes.append(index)
+    nlevels = min(len(index["levels"]) for index in indexes)
+    chosen = nlevels - 1
+    for k in range(nlevels):
+        sizes = indexes[0]["levels"][k]["sizes"]
+        steps = sum(index["levels"][k]["sizes"].get("time", 0) for index in indexes)
+        if (size is None or sizes.get("lon", 0) <= size) and (
+            frames is None or steps <= frames
+        ):
+            chosen = k
+            break
+    files = [
+        (
+            input_
+            if chosen == 0
+            else os.path.join(directory(input_), index["levels"][chosen]["file"])
+        )
+        for input_, index in zip(inputs, indexes)
+    ]
+    return files, indexes[0]["levels"][chosen]["factor"]
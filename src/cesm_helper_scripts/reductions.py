@@ -0,0 +1,110 @@
+"""Spatial reductions computed while aggregating.
+
+A reduction is given as a string:
+
+- `global`: area weighted mean over the globe.
+- `zonal`: mean over longitude.
+- `box:LAT0,LAT1,LON0,LON1`: area weighted mean over a lat/lon box. The longitudes may
+  wrap around, e.g. `box:-10,10,340,20`.
+
+Vertical selections are done with `select_levels` before the reductions.
+"""
+
+from typing import Callable, Dict, List, Optional
+
+import xarray as xr
+
+from cesm_helper_scripts import weights
+
+
+def _box(spec: str) -> Callable:
+    try:
+        region = tuple(float(v) for v in spec.split(","))
+    except ValueError as e:
+        raise ValueError(
+            f"a box is given as box:LAT0,LAT1,LON0,LON1, not {spec}"
+        ) from e
+    if len(region) != 4:
+        raise ValueError(f"a box is given as box:LAT0,LAT1,LON0,LON1, not {spec}")
+    return lambda da: weights.spatial_mean(da, region)
+
+
+def parse(spec: str) -> Callable:
+    """Return the function computing the reduction `spec`.
+
+    Parameters
+    ----------
+    spec : str
+        The reduction, see the module documentation.
+
+    Returns
+    -------
+    Callable
+        A function taking the data.
+
+    Raises
+    ------
+    ValueError
+        If `spec` is not a known reduction.
+    """
+    if spec == "global":
+        return weights.spatial_mean
+    if spec == "zonal":
+        return lambda da: da.mean("lon")
+    if spec.startswith("box:"):
+        return _box(spec[4:])
+    raise ValueError(f"unknown reduction {spec}, use global, zonal or box:...")
+
+
+def suffix(spec: str) -> str:
+    """Return the file name suffix of a reduction, e.g. `_global` or `_box_-10_10_0_30`."""
+    return "_" + spec.replace("box:", "box_").replace(",", "_")
+
+
+def select_levels(da: xr.DataArray, levels: Optional[List[float]]) -> xr.DataArray:
+    """Select the levels closest to `levels` (in hPa), if `da` has a `lev` dimension.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The data.
+    levels : Optional[List[float]]
+        The levels to keep. All levels are kept if not given.
+
+    Returns
+    -------
+    xr.DataArray
+        The data on the selected levels.
+    """
+    if not levels or "lev" not in da.dims:
+        return da
+    return da.sel(lev=levels, method="nearest")
+
+
+def reduce(
+    da: xr.DataArray, specs: List[str], gw: Optional[xr.DataArray] = None
+) -> Dict[str, xr.DataArray]:
+    """Compute all reductions in `specs` of `da`, lazily.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The data, with `lat` and `lon` dimensions.
+    specs : List[str]
+        The reductions, see the module documentation.
+    gw : Optional[xr.DataArray]
+        The Gaussian weights of the grid. If not given, the weights are found as
+        described in `weights.grid_weights`.
+
+    Returns
+    -------
+    Dict[str, xr.DataArray]
+        The reduced data by file name suffix, see `suffix`.
+    """
+    if gw is not None:
+        da = da.assign_coords(gw=gw)
+    out = {}
+    for spec in specs:
+        reduced = parse(spec)(da).astype(da.dtype).drop_vars("gw", errors="ignore")
+        out[suffix(spec)] = reduced.rename(da.name).assign_attrs(da.attrs)
+    return out
@@ -1,48 +1,340 @@
+"""Remove the seasonal cycle in the frequency domain.
+
+All frequencies between 0.7 and 10.3 cycles per year are removed with a real FFT along
+the time axis. The input can be a `.npz` file or `npy` directory from `nc2np`, or an
+aggregated NetCDF file or Zarr store from `gen_agg`, in which case full `(time, lat,
+lon)` or `(time, lev, lat, lon)` fields are filtered chunk by chunk over space.
+
+With `--method climatology`, a monthly or daily climatology is subtracted instead, see
+`climatology`.
+
+Usage:
+    remove-seasonal T20210504.npz --plot
+    remove-seasonal T20210504.nc --workers 8
+    echo T20210504.npz | remove-seasonal
+"""
+
+import argparse
 import os
 import sys
+from typing import Dict, List, Optional, Tuple
 
-import matplotlib.pyplot as plt
+import dask
+import dask.array
 import numpy as np
+import xarray as xr
 
+from cesm_helper_scripts import climatology, npy_store, profiling
 
-def remove_seasonal() -> None:
-    # Check file path
-    data = sys.stdin.readlines()
-    filename = data[0].strip("\n")
-    if not isinstance(filename, str) or filename[-4:] != ".npz":
-        raise TypeError(f"Are you sure {filename} is a valid .npz file?")
-    if not os.path.exists(filename):
-        raise FileNotFoundError(f"Cannot find file named {filename}.")
-    base = filename[:-4]
-    with np.load(filename, "r") as f:
-        times = f["times"]
-        values = f["data"]
-    # Remove seasonal cycle in frequency domain
-    # print(times)
-    fr = np.fft.fftfreq(len(times), times[1] - times[0])
-    sg = np.fft.fft(values)
-    plt.figure()
-    plt.semilogy(fr, sg.real, label="real")
-    plt.semilogy(fr, sg.imag, label="imag")
-    plt.legend()
-    idx = np.argwhere((fr > 0.7) & (fr < 10.3))
-    sg[idx] = sg[idx].imag
-    idx = np.argwhere((fr > -10.3) & (fr < -0.7))
-    sg[idx] = sg[idx].imag
-    sg_time = np.fft.ifft(sg)
-    sg_real = sg_time.real.astype(np.float32)
+BAND = (0.7, 10.3)
+# Entries of nc2np output that are not data.
+_AXES = ("times", "t_0", "lev", "ilev", "lat", "lon")
+
+parser = argparse.ArgumentParser(
+    description="Remove the seasonal cycle from the output of nc2np or gen_agg."
+)
+parser.add_argument(
+    "input",
+    nargs="?",
+    default=None,
+    help="A .npz file or npy directory from nc2np, or a .nc file or .zarr store from"
+    + " gen_agg. Read from stdin if not given.",
+)
+parser.add_argument(
+    "-v",
+    "--variables",
+    type=str,
+    nargs="+",
+    default=None,
+    help="The variables of a .nc/.zarr input to filter. All variables over time if"
+    + " not given.",
+)
+parser.add_argument(
+    "--band",
+    type=float,
+    nargs=2,
+    default=list(BAND),
+    help="The frequencies (cycles per year) that are removed.",
+)
+parser.add_argument(
+    "--method",
+    type=str,
+    default="fft",
+    choices=("fft", "climatology"),
+    help="Remove the seasonal band with an FFT, or subtract a monthly or daily"
+    + " climatology (only for .nc/.zarr input). The climatology is computed in one"
+    + " pass over the file, and the anomalies are written in a second pass.",
+)
+parser.add_argument(
+    "--freq",
+    type=str,
+    default="month",
+    choices=("month", "day"),
+    help="Use a climatology for each month or each day of the year.",
+)
+parser.add_argument(
+    "--variance",
+    action="store_true",
+    help="Also save the variance in the climatology file.",
+)
+parser.add_argument(
+    "--max-memory",
+    type=str,
+    default="1GB",
+    help="Bound on the memory used by the climatology and the data with --method"
+    + " climatology.",
+)
+parser.add_argument(
+    "--plot", action="store_true", help="Show the spectrum and the filtered series."
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of threads used to filter the chunks of full fields.",
+)
+parser.add_argument(
+    "--profile",
+    type=str,
+    nargs="?",
+    const="remove_seasonal_profile.json",
+    default=None,
+    help="Save the time, CPU time, peak memory and bytes read and written of each"
+    + " stage to this JSON file (default: remove_seasonal_profile.json).",
+)
+
+
+def filter_seasonal(
+    values: np.ndarray, dt: float, axis: int = 0, band: Tuple[float, float] = BAND
+) -> np.ndarray:
+    """Remove the frequencies in `band` along `axis`.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The data, real valued.
+    dt : float
+        The time step in years.
+    axis : int
+        The time axis.
+    band : Tuple[float, float]
+        The lowest and highest frequency in cycles per year that is removed.
+
+    Returns
+    -------
+    np.ndarray
+        The filtered data, with the same shape.
+    """
+    n = values.shape[axis]
+    fr = np.fft.rfftfreq(n, dt)
+    sg = np.fft.rfft(values, axis=axis)
+    shape = [1] * values.ndim
+    shape[axis] = len(fr)
+    sg *= ((fr <= band[0]) | (fr >= band[1])).reshape(shape)
+    sg_time = np.fft.irfft(sg, n, axis=axis)
+    return sg_time.astype(np.result_type(values.dtype, np.float32), copy=False)
+
+
+def _filter_dask(
+    values: dask.array.Array, dt: float, band: Tuple[float, float]
+) -> dask.array.Array:
+    # Every chunk needs the full time series, so only the space is chunked. The spatial
+    # chunks are sized by dask (`array.chunk-size`), so that each block is a bounded
+    # tile even if the input is one block.
+    values = values.rechunk({0: -1, **{i: "auto" for i in range(1, values.ndim)}})
+    dtype = np.result_type(values.dtype, np.float32)
+    return values.map_blocks(filter_seasonal, dt, 0, band, dtype=dtype)
+
+
+def filter_dataarray(
+    da: xr.DataArray, band: Tuple[float, float] = BAND
+) -> xr.DataArray:
+    """Remove the seasonal cycle of a field on the calendar without leap years.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The data, with a `time` dimension with equal time steps.
+    band : Tuple[float, float]
+        The frequencies that are removed, see `filter_seasonal`.
 
+    Returns
+    -------
+    xr.DataArray
+        The filtered data, lazy if `da` is a dask array.
+    """
+    # Imported here, nc_to_np is only needed for the time axis of NetCDF input.
+    from cesm_helper_scripts.nc_to_np import decimal_years
+
+    times, _ = decimal_years(da.time.data)
+    dt = times[1] - times[0]
+    da = da.transpose("time", ...)
+    if da.chunks is None:
+        values = filter_seasonal(da.values, dt, 0, band)
+    else:
+        values = _filter_dask(da.data, dt, band)
+    return da.copy(data=values)
+
+
+def _plot(times: np.ndarray, values: np.ndarray, filtered: np.ndarray) -> None:
+    import matplotlib.pyplot as plt
+
+    # Spatial fields are shown as the mean over space.
+    values = values.reshape(len(times), -1).mean(axis=1)
+    filtered = filtered.reshape(len(times), -1).mean(axis=1)
+    fr = np.fft.fftfreq(len(times), times[1] - times[0])
+    for sg in (np.fft.fft(values), np.fft.fft(filtered)):
+        plt.figure()
+        plt.semilogy(fr, sg.real, label="real")
+        plt.semilogy(fr, sg.imag, label="imag")
+        plt.legend()
     plt.figure()
     plt.plot(times, values, label="original")
-    plt.plot(times, sg_real, label="removed")
-    plt.legend()
-    plt.figure()
-    plt.semilogy(fr, sg.real, label="real")
-    plt.semilogy(fr, sg.imag, label="imag")
+    plt.plot(times, filtered, label="removed")
     plt.legend()
     plt.show()
 
-    np.savez(f"{base}_seasonal_removed.npz", times=times, data=sg_real)
+
+def remove_seasonal_np(
+    filename: str, band: Tuple[float, float] = BAND, plot: bool = False
+) -> str:
+    """Remove the seasonal cycle from all arrays in the output of nc2np.
+
+    Parameters
+    ----------
+    filename : str
+        The `.npz` file or `npy` directory.
+    band : Tuple[float, float]
+        The frequencies that are removed, see `filter_seasonal`.
+    plot : bool
+        Show the spectrum and the series before and after.
+
+    Returns
+    -------
+    str
+        The output, `<base>_seasonal_removed.npz` (or a directory).
+    """
+    store = os.path.isdir(filename)
+    base = filename.rstrip("/") if store else filename[:-4]
+    out: Dict = {}
+    with npy_store.load(filename, "r") as f:
+        times = np.asarray(f["times"])
+        dt = times[1] - times[0]
+        for name in f.files:
+            if name in _AXES:
+                # The axes of a .npz file may be saved as None, which cannot be read
+                # without pickle. Only the times are kept, as before.
+                if store or name == "times":
+                    out[name] = f[name]
+                continue
+            values = f[name]
+            if store and values.ndim > 2:
+                # Full fields are memory-mapped, and filtered chunk by chunk when
+                # they are saved.
+                filtered = _filter_dask(dask.array.from_array(values), dt, band)
+            else:
+                with profiling.stage(f"filter {name}"):
+                    filtered = filter_seasonal(np.asarray(values), dt, 0, band)
+                    filtered = filtered.astype(np.float32)
+            if plot:
+                _plot(times, np.asarray(values), np.asarray(filtered))
+            out[name] = filtered
+        meta = f.meta if store else None
+    if store:
+        meta = {k: v for k, v in meta.items() if k != "arrays"}
+        with profiling.stage("save"):
+            return npy_store.save(f"{base}_seasonal_removed", out, meta)
+    with profiling.stage("save"):
+        np.savez(f"{base}_seasonal_removed.npz", **out)
+    return f"{base}_seasonal_removed.npz"
+
+
+def remove_seasonal_nc(
+    filename: str,
+    variables: Optional[List[str]] = None,
+    band: Tuple[float, float] = BAND,
+    plot: bool = False,
+) -> str:
+    """Remove the seasonal cycle from the fields of an aggregated file.
+
+    Parameters
+    ----------
+    filename : str
+        The `.nc` file or `.zarr` store.
+    variables : Optional[List[str]]
+        The variables to filter. All variables over time if not given.
+    band : Tuple[float, float]
+        The frequencies that are removed, see `filter_seasonal`.
+    plot : bool
+        Show the spectrum and the series before and after, averaged over space.
+
+    Returns
+    -------
+    str
+        The output, `<base>_seasonal_removed.nc` (or `.zarr`).
+    """
+    zarr = filename.rstrip("/").endswith(".zarr")
+    base, ext = os.path.splitext(filename.rstrip("/"))
+    with profiling.stage("open"):
+        ds = xr.open_dataset(
+            filename, chunks={}, engine="zarr" if zarr else None, decode_times=True
+        )
+    if variables is None:
+        variables = [v for v in ds.data_vars if "time" in ds[v].dims]
+        variables = [v for v in variables if ds[v].dtype.kind == "f"]
+    out = ds.copy()
+    for v in variables:
+        out[v] = filter_dataarray(ds[v], band).transpose(*ds[v].dims)
+    name = f"{base}_seasonal_removed{ext}"
+    # The fields are read, filtered and written in one compute.
+    with profiling.stage("compute and save"):
+        if zarr:
+            out.to_zarr(name, mode="w")
+        else:
+            out.to_netcdf(name)
+    if plot:
+        from cesm_helper_scripts.nc_to_np import decimal_years
+
+        times, _ = decimal_years(ds.time.data)
+        for v in variables:
+            _plot(times, ds[v].values, out[v].values)
+    ds.close()
+    return name
+
+
+def remove_seasonal() -> None:
+    """Run the main function for the script."""
+    args = parser.parse_args()
+    filename = args.input
+    if filename is None:
+        # The file name used to be given on stdin, e.g. `echo file.npz | ...`.
+        filename = sys.stdin.readlines()[0].strip("\n")
+    if not os.path.exists(filename):
+        raise FileNotFoundError(f"Cannot find file named {filename}.")
+    band = tuple(args.band)
+    # The FFTs release the GIL, so the chunks are filtered in a thread pool.
+    session = profiling.session(args.profile)
+    with session, dask.config.set(scheduler="threads", num_workers=args.workers):
+        if args.method == "climatology":
+            if not filename.rstrip("/").endswith((".nc", ".zarr")):
+                raise TypeError("--method climatology needs a .nc file or .zarr store")
+            out = ", ".join(
+                climatology.run(
+                    filename,
+                    args.variables,
+                    args.freq,
+                    args.variance,
+                    args.max_memory,
+                    args.workers,
+                )
+            )
+        elif filename.rstrip("/").endswith((".nc", ".zarr")):
+            out = remove_seasonal_nc(filename, args.variables, band, args.plot)
+        elif os.path.isdir(filename) or filename[-4:] == ".npz":
+            out = remove_seasonal_np(filename, band, args.plot)
+        else:
+            raise TypeError(f"Are you sure {filename} is a valid .npz file?")
+    print("Saved to", out)
 
 
 if __name__ == "__main__":
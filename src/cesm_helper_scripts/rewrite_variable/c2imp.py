@@ -0,0 +1,219 @@
+"""Mimic `cycle` with `interp_missing_month` for forcing files.
+
+A forcing file that CESM2 uses in `cycle` mode on one year (1850) gives the same input in
+`interp_missing_month` mode if the months of that year are repeated as year 1 and year
+9999. The new file is written directly from the 1850 slice of the input, with each
+variable copied in bulk, and with the variables that do not depend on time (e.g. `P0`,
+`hyai`, `hyam`, `hybi` and `hybm`) included. No temporary files are written.
+
+Usage:
+    c2imp in.nc
+    c2imp forcing/ -o interp_missing_months --done done
+"""
+
+import argparse
+import glob
+import os
+import shutil
+from typing import List, Optional
+
+import cftime
+import netCDF4
+import numpy as np
+
+YEARS = (1, 9999)
+
+parser = argparse.ArgumentParser(
+    description="Repeat the cycle year of CESM2 forcing files as year 1 and 9999, for"
+    + " use with interp_missing_month."
+)
+parser.add_argument(
+    "input",
+    type=str,
+    nargs="+",
+    help="Forcing .nc files, or directories where all .nc files are converted.",
+)
+parser.add_argument(
+    "-o",
+    "--outdir",
+    type=str,
+    default=None,
+    help="Directory of the output files `<name>_1_9999.nc`. Defaults to"
+    + " `interp_missing_months/` next to each input.",
+)
+parser.add_argument(
+    "--year", type=int, default=1850, help="The year that is used in cycle mode."
+)
+parser.add_argument(
+    "--done",
+    type=str,
+    default=None,
+    help="Move each converted input to this directory.",
+)
+
+
+def _shifted_time(time: netCDF4.Variable, index: np.ndarray, year: int) -> np.ndarray:
+    calendar = getattr(time, "calendar", "standard")
+    dates = cftime.num2date(time[index], time.units, calendar)
+    new = [d.replace(year=year) for d in dates]
+    return np.asarray(cftime.date2num(new, time.units, calendar), dtype=time.dtype)
+
+
+def convert(filename: str, out: str, year: int = 1850) -> str:
+    """Write the months of `year` as the months of year 1 and year 9999.
+
+    Parameters
+    ----------
+    filename : str
+        The forcing file.
+    out : str
+        The new file.
+    year : int
+        The year that is used in cycle mode.
+
+    Returns
+    -------
+    str
+        The new file.
+
+    Raises
+    ------
+    ValueError
+        If `filename` has no time steps in `year`.
+    """
+    with netCDF4.Dataset(filename, "r") as src:
+        src.set_auto_maskandscale(False)
+        src.set_auto_chartostring(False)
+        time = src.variables["time"]
+        calendar = getattr(time, "calendar", "standard")
+        years = np.array(
+            [d.year for d in cftime.num2date(time[:], time.units, calendar)]
+        )
+        index = np.flatnonzero(years == year)
+        if not len(index):
+            raise ValueError(f"{filename} has no time steps in the year {year}")
+        n = len(index)
+        # Read only the steps of `year`, as one slice if they are consecutive.
+        steps = (
+            slice(index[0], index[-1] + 1) if index[-1] - index[0] == n - 1 else index
+        )
+        # The time of each step in year 1 and 9999. The bounds are moved by the same
+        # amount as the time step they belong to.
+        times = [_shifted_time(time, index, y) for y in YEARS]
+        shifts = [t - time[index] for t in times]
+        bounds = getattr(time, "bounds", None)
+        with netCDF4.Dataset(out, "w", format=src.data_model) as dst:
+            dst.setncatts({a: src.getncattr(a) for a in src.ncattrs()})
+            for name, dim in src.dimensions.items():
+                size = None if dim.isunlimited() else len(dim)
+                dst.createDimension(name, 2 * n if name == "time" and size else size)
+            for name, var in src.variables.items():
+                fill = (
+                    var.getncattr("_FillValue")
+                    if "_FillValue" in var.ncattrs()
+                    else None
+                )
+                filters = var.filters() or {}
+                chunks = (
+                    var.chunking() if src.data_model.startswith("NETCDF4") else None
+                )
+                if isinstance(chunks, list):
+                    # A fixed time dimension is shorter than the chunks may have been.
+                    chunks = [
+                        min(c, len(dst.dimensions[d]) or c)
+                        for c, d in zip(chunks, var.dimensions)
+                    ]
+                new = dst.createVariable(
+                    name,
+                    var.datatype,
+                    var.dimensions,
+                    zlib=bool(filters.get("zlib")),
+                    complevel=filters.get("complevel", 4),
+                    shuffle=bool(filters.get("shuffle")),
+                    contiguous=chunks == "contiguous",
+                    chunksizes=chunks if isinstance(chunks, list) else None,
+                    fill_value=fill,
+                )
+                new.set_auto_maskandscale(False)
+                new.set_auto_chartostring(False)
+                new.setncatts(
+                    {a: var.getncattr(a) for a in var.ncattrs() if a != "_FillValue"}
+                )
+                if "time" not in var.dimensions:
+                    new[...] = var[...]
+                    continue
+                axis = var.dimensions.index("time")
+                values = var[
+                    tuple(steps if d == "time" else slice(None) for d in var.dimensions)
+                ]
+                if name == "time":
+                    blocks = times
+                elif name == bounds:
+                    blocks = [values + s.reshape(-1, 1) for s in shifts]
+                elif name == "date":
+                    blocks = [values % 10000 + y * 10000 for y in YEARS]
+                else:
+                    blocks = [values, values]
+                new[...] = np.concatenate(blocks, axis=axis)
+    return out
+
+
+def convert_many(
+    inputs: List[str],
+    outdir: Optional[str] = None,
+    year: int = 1850,
+    done: Optional[str] = None,
+) -> List[str]:
+    """Convert many forcing files, see `convert`.
+
+    Parameters
+    ----------
+    inputs : List[str]
+        Forcing files, or directories where all `.nc` files are converted.
+    outdir : Optional[str]
+        Directory of the new files. Defaults to `interp_missing_months/` next to each
+        input.
+    year : int
+        The year that is used in cycle mode.
+    done : Optional[str]
+        Move each converted input to this directory.
+
+    Returns
+    -------
+    List[str]
+        The new files.
+
+    Raises
+    ------
+    FileNotFoundError
+        If an input does not exist.
+    """
+    files = []
+    for input_ in inputs:
+        if os.path.isdir(input_):
+            files.extend(sorted(glob.glob(os.path.join(input_, "*.nc"))))
+        elif os.path.isfile(input_):
+            files.append(input_)
+        else:
+            raise FileNotFoundError(f"Cannot find {input_}.")
+    outs = []
+    for f in files:
+        directory = outdir or os.path.join(os.path.dirname(f), "interp_missing_months")
+        os.makedirs(directory, exist_ok=True)
+        name = f"{os.path.splitext(os.path.basename(f))[0]}_1_9999.nc"
+        outs.append(convert(f, os.path.join(directory, name), year))
+        print("Saved to", outs[-1])
+        if done is not None:
+            os.makedirs(done, exist_ok=True)
+            shutil.move(f, os.path.join(done, os.path.basename(f)))
+    return outs
+
+
+def main():
+    """Run the main function for the script."""
+    args = parser.parse_args()
+    convert_many(args.input, args.outdir, args.year, args.done)
+
+
+if __name__ == "__main__":
+    main()
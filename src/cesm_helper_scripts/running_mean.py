@@ -0,0 +1,183 @@
+"""Calendar weighted running and block means along time.
+
+The running mean is computed from cumulative sums, so every time step is visited once
+regardless of the window length, and the dask chunks along time are kept as they are.
+Each time step is weighted by its length in days, which matters for monthly output on
+the `noleap` calendar where months are 28 to 31 days long.
+"""
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+BLOCKS = {"year": "YS", "season": "QS-DEC"}
+
+
+def _days(times: np.ndarray) -> np.ndarray:
+    # Works for both cftime objects and numpy datetime64.
+    deltas = np.asarray(times - times[0])
+    return pd.to_timedelta(deltas).total_seconds().to_numpy() / 86400
+
+
+def step_weights(
+    time: xr.DataArray, bounds: Optional[xr.DataArray] = None
+) -> xr.DataArray:
+    """Return the length in days of each time step.
+
+    Parameters
+    ----------
+    time : xr.DataArray
+        The time coordinate.
+    bounds : Optional[xr.DataArray]
+        The time bounds, with shape `(time, 2)`, e.g. `time_bnds` of CESM history
+        files. If not given, the distance to the previous time step is used, and the
+        first time step gets the same weight as the second.
+
+    Returns
+    -------
+    xr.DataArray
+        Weights along the time dimension.
+    """
+    if bounds is not None:
+        b = bounds.values
+        days = _days(np.concatenate([b[:, 0], b[:, 1]]))
+        days = days[len(b) :] - days[: len(b)]
+    elif len(time) > 1:
+        days = np.diff(_days(time.values))
+        days = np.concatenate([days[:1], days])
+    else:
+        days = np.ones(len(time))
+    return xr.DataArray(days, coords={"time": time}, dims="time", name="weights")
+
+
+def step_midpoints(
+    time: xr.DataArray, bounds: Optional[xr.DataArray] = None
+) -> xr.DataArray:
+    """Return the middle of the averaging interval of each time step.
+
+    Parameters
+    ----------
+    time : xr.DataArray
+        The time coordinate. CESM puts the time stamp at the end of the interval.
+    bounds : Optional[xr.DataArray]
+        The time bounds. If not given (e.g. in files written by `gen_agg`), each
+        interval is taken to end at its time stamp, with the length from
+        `step_weights`.
+
+    Returns
+    -------
+    xr.DataArray
+        The middle of each interval, along the time dimension.
+    """
+    if bounds is not None:
+        b = bounds.values
+        middle = b[:, 0] + (b[:, 1] - b[:, 0]) / 2
+    else:
+        half = pd.to_timedelta(step_weights(time).values / 2, unit="D")
+        if time.dtype.kind == "M":
+            middle = time.values - half.to_numpy()
+        else:
+            # cftime objects only subtract python timedeltas.
+            middle = time.values - np.asarray(half.to_pytimedelta())
+    return xr.DataArray(middle, coords={"time": time}, dims="time")
+
+
+def running_mean(
+    da: xr.DataArray,
+    window: int = 12,
+    center: bool = False,
+    weights: Optional[xr.DataArray] = None,
+) -> xr.DataArray:
+    """Compute a weighted running mean along time in one cumulative pass.
+
+    The result matches `da.rolling(time=window, center=center).mean()` when all
+    weights are equal: the first `window - 1` values (or the edges when centered), as
+    well as windows with missing values, are NaN.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The data, with a `time` dimension.
+    window : int
+        Number of time steps in each window.
+    center : bool
+        If True, the result is set at the center of the window.
+    weights : Optional[xr.DataArray]
+        Weight of each time step, see `step_weights`. Defaults to equal weights.
+
+    Returns
+    -------
+    xr.DataArray
+        The running mean, with the same shape and chunks as `da`.
+    """
+    if weights is None:
+        weights = xr.ones_like(da.time, dtype=float)
+    valid = da.notnull()
+    w = weights.where(valid, 0.0)
+    # Accumulate in double precision, long float32 sums lose digits.
+    total = (da.astype("f8").fillna(0.0) * w).cumsum("time")
+    norm = w.cumsum("time")
+    count = valid.cumsum("time")
+
+    def _window(cum):
+        if window >= da.sizes["time"]:
+            # Shifting everything out fails with dask, and would leave only zeros.
+            return cum
+        return cum - cum.shift(time=window, fill_value=0)
+
+    mean = (_window(total) / _window(norm)).where(_window(count) == window)
+    if center:
+        # Same alignment as xarray's rolling, moved back ceil(window / 2) - 1 steps.
+        mean = mean.shift(time=-(-(-window // 2) - 1))
+    mean = mean.astype(da.dtype).transpose(*da.dims)
+    return mean.rename(da.name).assign_attrs(da.attrs)
+
+
+def block_mean(
+    da: xr.DataArray,
+    block: str = "year",
+    weights: Optional[xr.DataArray] = None,
+    bounds: Optional[xr.DataArray] = None,
+) -> xr.DataArray:
+    """Compute weighted means over calendar years or seasons.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        The data, with a `time` dimension.
+    block : str
+        One of the keys in `BLOCKS`. Seasons are DJF, MAM, JJA and SON.
+    weights : Optional[xr.DataArray]
+        Weight of each time step, see `step_weights`. Defaults to equal weights.
+    bounds : Optional[xr.DataArray]
+        The time bounds. CESM puts the time stamp at the end of the averaging
+        interval, so if the bounds are given the middle of the interval is used to
+        decide which block a time step belongs to.
+
+    Returns
+    -------
+    xr.DataArray
+        One value per block, labelled by the start of the block.
+
+    Raises
+    ------
+    ValueError
+        If `block` is not known.
+    """
+    if block not in BLOCKS:
+        raise ValueError(f"block must be one of {list(BLOCKS)}, not {block}")
+    if weights is None:
+        weights = xr.ones_like(da.time, dtype=float)
+    if bounds is not None:
+        b = bounds.values
+        middle = b[:, 0] + (b[:, 1] - b[:, 0]) / 2
+        da = da.assign_coords(time=middle)
+        weights = weights.assign_coords(time=middle)
+    w = weights.where(da.notnull(), 0.0)
+    total = (da.fillna(0.0) * w).resample(time=BLOCKS[block]).sum()
+    norm = w.resample(time=BLOCKS[block]).sum()
+    mean = (total / norm).where(norm > 0)
+    mean = mean.astype(da.dtype).transpose(*da.dims)
+    return mean.rename(da.name).assign_attrs(da.attrs)
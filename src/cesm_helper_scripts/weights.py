@@ -0,0 +1,145 @@
+"""Area weights and fast area weighted means over lat/lon grids.
+
+The weights are taken from the cell areas (`area`) if they are present as a coordinate
+of the data, else from the Gaussian weights (`gw`), and else from cos(lat). They are
+normalized to sum to one over the grid (or region), and cached per grid, so the mean
+over lat/lon is a single contraction of each chunk with the weight matrix.
+
+Example:
+    from cesm_helper_scripts import weights
+    global_mean = weights.spatial_mean(da)
+    tropics = weights.spatial_mean(da, region=(-30, 30, 0, 360))
+"""
+
+import hashlib
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+
+Region = Tuple[float, float, float, float]
+
+_CACHE: Dict[Tuple, np.ndarray] = {}
+_CACHE_SIZE = 32
+
+
+def _digest(*arrays: np.ndarray) -> str:
+    sha = hashlib.sha1()
+    for a in arrays:
+        sha.update(np.ascontiguousarray(a, dtype=float).tobytes())
+    return sha.hexdigest()
+
+
+def _in_region(lat: np.ndarray, lon: np.ndarray, region: Region) -> np.ndarray:
+    lat_0, lat_1, lon_0, lon_1 = region
+    lon_0, lon_1 = lon_0 % 360, lon_1 % 360
+    lon = lon % 360
+    if lon_0 < lon_1 or region[2] == region[3]:
+        in_lon = (lon >= lon_0) & (lon <= lon_1)
+    else:
+        # The box wraps around, e.g. 340 to 20, or covers all longitudes, 0 to 360.
+        in_lon = (lon >= lon_0) | (lon <= lon_1)
+    in_lat = (lat >= min(lat_0, lat_1)) & (lat <= max(lat_0, lat_1))
+    return in_lat[:, None] & in_lon[None, :]
+
+
+def grid_weights(da: xr.DataArray, region: Optional[Region] = None) -> np.ndarray:
+    """Return the normalized area weights of the grid of `da`.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Data with `lat` and `lon` dimensions, and optionally `area` (lat, lon) or `gw`
+        (lat) coordinates. Other dimensions of the weights, e.g. time, are left out.
+    region : Optional[Region]
+        A box (lat_0, lat_1, lon_0, lon_1) in degrees. The weights are zero outside of
+        the box. The longitudes may wrap around, e.g. (-10, 10, 340, 20).
+
+    Returns
+    -------
+    np.ndarray
+        Weights with shape (lat, lon) that sum to one.
+
+    Raises
+    ------
+    ValueError
+        If the region does not contain any grid cells.
+    """
+    lat, lon = da.lat.values, da.lon.values
+    name = next((n for n in ("area", "gw") if n in da.coords), None)
+    source = None
+    if name is not None:
+        weight = da.coords[name]
+        # Files opened with `xr.open_mfdataset` may have the weights stacked along
+        # time. They are the same for all time steps.
+        weight = weight.isel({d: 0 for d in weight.dims if d not in ("lat", "lon")})
+        source = weight.transpose("lat", ...).values
+    region = None if region is None else tuple(float(r) for r in region)
+    key = (_digest(lat, lon), None if source is None else _digest(source), region)
+    if key in _CACHE:
+        return _CACHE[key]
+    if source is None:
+        # Compensate for the different width of grid cells at different latitudes.
+        # https://xarray.pydata.org/en/stable/examples/area_weighted_temperature.html
+        source = np.cos(np.deg2rad(lat))
+    w = np.broadcast_to(
+        np.asarray(source, dtype="f8").reshape(len(lat), -1), (len(lat), len(lon))
+    )
+    if region is not None:
+        w = np.where(_in_region(lat, lon, region), w, 0.0)
+    total = w.sum()
+    if total == 0:
+        raise ValueError(f"the region {region} does not contain any grid cells")
+    w = w / total
+    w.flags.writeable = False
+    if len(_CACHE) >= _CACHE_SIZE:
+        _CACHE.pop(next(iter(_CACHE)))
+    _CACHE[key] = w
+    return w
+
+
+def _contract(block: np.ndarray, w: np.ndarray) -> np.ndarray:
+    out = np.tensordot(block, w, axes=2)
+    missing = np.isnan(out)
+    if missing.any():
+        # Only the maps with missing values are done again, leaving out the missing
+        # values, as in `xr.DataArray.weighted(...).mean(...)`.
+        maps = block[missing]
+        valid = ~np.isnan(maps)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[missing] = np.tensordot(np.where(valid, maps, 0), w, axes=2) / (
+                np.tensordot(valid, w, axes=2)
+            )
+    return out
+
+
+def spatial_mean(da: xr.DataArray, region: Optional[Region] = None) -> xr.DataArray:
+    """Compute the area weighted mean over lat/lon.
+
+    The same as `da.weighted(w).mean(("lat", "lon"))`, but computed as one contraction
+    of each chunk with the cached weights from `grid_weights`.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Data with `lat` and `lon` dimensions.
+    region : Optional[Region]
+        Only average over this box, see `grid_weights`.
+
+    Returns
+    -------
+    xr.DataArray
+        The mean, lazy if `da` is a dask array.
+    """
+    w = grid_weights(da, region)
+    if da.chunks is not None:
+        da = da.chunk({"lat": -1, "lon": -1})
+    out = xr.apply_ufunc(
+        _contract,
+        da.reset_coords([c for c in ("area", "gw") if c in da.coords], drop=True),
+        input_core_dims=[["lat", "lon"]],
+        kwargs={"w": w},
+        dask="parallelized",
+        output_dtypes=[np.result_type(da.dtype, w.dtype)],
+    )
+    return out.assign_attrs(da.attrs)
@@ -0,0 +1,113 @@
+"""Time the startup of `cplt`, and list the heavy modules each run imports.
+
+`cplt --help` should not import any of them, and a `simple` plot should not import the
+animation and map backends (animatplot, basemap).
+
+Usage:
+    python bench_cplt_startup.py [--repeat 5]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY = (
+    "xarray",
+    "cftime",
+    "matplotlib.pyplot",
+    "cosmoplots",
+    "animatplot",
+    "mpl_toolkits.basemap",
+)
+# Run `cplt` in a new interpreter, and print the heavy modules it imported, also if the
+# plot fails (e.g. without latex).
+RUN = """
+import json, sys
+sys.argv = ["cplt", *json.loads(sys.argv[1])]
+error = None
+try:
+    from cesm_helper_scripts import create_plots
+    create_plots.main()
+except SystemExit:
+    pass
+except Exception as e:
+    error = repr(e)
+print(json.dumps({{"imported": [m for m in {heavy} if m in sys.modules], "error": error}}))
+"""
+
+
+def _make_input(directory: str) -> str:
+    import numpy as np
+    import xarray as xr
+
+    da = xr.DataArray(
+        np.random.default_rng(0).random((24, 8, 16), dtype="f4"),
+        dims=("time", "lat", "lon"),
+        coords={
+            "time": xr.date_range("0001-01-01", periods=24, freq="MS", use_cftime=True),
+            "lat": np.linspace(-80, 80, 8),
+            "lon": np.linspace(0, 337.5, 16),
+        },
+        name="T",
+    )
+    name = os.path.join(directory, "T.nc")
+    da.to_netcdf(name)
+    return name
+
+
+def run(cli: list, repeat: int) -> dict:
+    """Run `cplt` with the arguments `cli` `repeat` times.
+
+    Parameters
+    ----------
+    cli : list
+        The arguments.
+    repeat : int
+        Number of runs.
+
+    Returns
+    -------
+    dict
+        The median wall time in seconds, the heavy modules that were imported, and the
+        error of the last run, if any.
+    """
+    code = RUN.format(heavy=HEAVY)
+    times: list = []
+    result: dict = {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-c", code, json.dumps(cli)],
+            capture_output=True,
+            text=True,
+        )
+        times.append(time.perf_counter() - start)
+    result["seconds"] = statistics.median(times)
+    result.update(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return result
+
+
+def main() -> None:
+    """Run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each case.")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        name = os.path.basename(_make_input(directory))
+        common = ["-i", name, "-p", directory, "-sp", "input", "-o", "T", "-y"]
+        cases = {
+            "help": ["--help"],
+            "maps": ["--maps"],
+            "simple": [*common, "-plt", "simple"],
+        }
+        results = {case: run(cli, args.repeat) for case, cli in cases.items()}
+    print(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
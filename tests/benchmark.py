@@ -0,0 +1,277 @@
+"""Benchmark the entry points on generated data, for all netCDF formats.
+
+For each size in `SIZES` and each format in `create_data.FileFormat`, a run is generated
+with `create_data.Dataset` and `gen_agg`, `nc2np`, `remove-seasonal` and `cplt` are run on
+it in new processes. The wall time, the throughput (size of the input over the wall
+time) and the peak RSS of each step are saved as JSON, together with the commit, so runs
+on different commits can be compared:
+
+    python benchmark.py --sizes small medium -o before.json
+    python benchmark.py --sizes small medium -o after.json --compare before.json
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import create_data as cd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "..", "src")
+GEN_AGG = os.path.join(SRC, "cesm_helper_scripts", "gen_agg")
+# Keyword arguments of `create_data.Dataset` for each size.
+SIZES: Dict[str, Dict] = {
+    "tiny": {"nlat": 24, "nlon": 48, "nlev": 8, "years": 2},
+    "small": {"nlat": 48, "nlon": 96, "nlev": 16, "years": 5},
+    "medium": {"nlat": 96, "nlon": 144, "nlev": 32, "years": 20},
+    "large": {"nlat": 192, "nlon": 288, "nlev": 70, "years": 50},
+}
+VARIABLES = ["T", "TREFHT", "FLNT"]
+# Slower steps than this fraction are reported as regressions by `--compare`.
+TOLERANCE = 0.2
+
+
+def _size(paths: List[str]) -> int:
+    total = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        elif os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def measure(argv: List[str], inputs: List[str], cwd: str) -> Dict:
+    """Run `argv` in a new process and measure it.
+
+    Parameters
+    ----------
+    argv : List[str]
+        The command.
+    inputs : List[str]
+        The files read by the command, used for the throughput.
+    cwd : str
+        The working directory of the command.
+
+    Returns
+    -------
+    Dict
+        The wall time in seconds, the size of the input in MB, the throughput in MB/s,
+        the peak RSS of the process in MB, the return code and the end of stderr if the
+        command failed.
+    """
+    env = dict(
+        os.environ, PYTHONPATH=os.pathsep.join([SRC, os.environ.get("PYTHONPATH", "")])
+    )
+    input_mb = _size(inputs) / 1e6
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        argv,
+        cwd=cwd,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    stderr = proc.stderr.read() if proc.stderr is not None else b""
+    # `wait4` gives the resource usage of this process alone.
+    _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kB on Linux, and in bytes on macOS.
+    scale = 1e6 if sys.platform == "darwin" else 1e3
+    result = {
+        "argv": argv,
+        "seconds": seconds,
+        "input_mb": input_mb,
+        "mb_per_s": input_mb / seconds if seconds > 0 else None,
+        "peak_rss_mb": usage.ru_maxrss / scale,
+        "returncode": proc.returncode,
+    }
+    if proc.returncode != 0:
+        result["error"] = stderr.decode(errors="replace").strip().splitlines()[-1:]
+    return result
+
+
+def run_case(
+    size: str, file_format: cd.FileFormat, directory: str, workers: int
+) -> Dict:
+    """Generate one run and benchmark every entry point on it.
+
+    Parameters
+    ----------
+    size : str
+        A key of `SIZES`.
+    file_format : cd.FileFormat
+        The format of the history files.
+    directory : str
+        An empty directory for the data.
+    workers : int
+        Number of processes writing the history files.
+
+    Returns
+    -------
+    Dict
+        The results of each step, see `measure`.
+    """
+    py = sys.executable
+    start = time.perf_counter()
+    creator = cd.Dataset(directory, variables=VARIABLES, workers=workers, **SIZES[size])
+    creator.make_datasets(file_format)
+    history = sorted(glob.glob(os.path.join(directory, "*.cam.h0.*")))
+    steps = {
+        "create_data": {
+            "seconds": time.perf_counter() - start,
+            "output_mb": _size(history) / 1e6,
+        }
+    }
+    agg = {v: os.path.join(directory, f"{v}bench.nc") for v in VARIABLES}
+    steps["gen_agg"] = measure(
+        [py, GEN_AGG, "-a", *VARIABLES, "-p", directory, "-i", "simulation.cam.h0.*"]
+        + ["-o", "bench"],
+        history,
+        directory,
+    )
+    steps["nc2np"] = measure(
+        [py, "-m", "cesm_helper_scripts.nc_to_np", "-i", "TREFHTbench.nc"]
+        + ["-p", directory, "-o", "TREFHT", "-y"],
+        [agg["TREFHT"]],
+        directory,
+    )
+    steps["nc2np_npy_gridded"] = measure(
+        [py, "-m", "cesm_helper_scripts.nc_to_np", "-i", "Tbench.nc", "-p", directory]
+        + ["-o", "T", "-y", "--format", "npy", "--gridded"],
+        [agg["T"]],
+        directory,
+    )
+    steps["remove_seasonal_npz"] = measure(
+        [py, "-m", "cesm_helper_scripts.remove_seasonal", "TREFHT.npz"],
+        [os.path.join(directory, "TREFHT.npz")],
+        directory,
+    )
+    steps["remove_seasonal_nc"] = measure(
+        [py, "-m", "cesm_helper_scripts.remove_seasonal", "TREFHTbench.nc"],
+        [agg["TREFHT"]],
+        directory,
+    )
+    for plot in ("simple", "sphere"):
+        steps[f"cplt_{plot}"] = measure(
+            [py, "-m", "cesm_helper_scripts.create_plots", "-i", "TREFHTbench.nc"]
+            + ["-p", directory, "-o", "bench", "-y", "-plt", plot],
+            [agg["TREFHT"]],
+            directory,
+        )
+    return steps
+
+
+def _commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True
+        )
+    except FileNotFoundError:
+        return None
+    return out.stdout.strip() or None
+
+
+def compare(old: Dict, new: Dict, tolerance: float = TOLERANCE) -> List[str]:
+    """List the steps that are slower in `new` than in `old` by more than `tolerance`.
+
+    Parameters
+    ----------
+    old : Dict
+        Results saved by this script.
+    new : Dict
+        Results saved by this script.
+    tolerance : float
+        Relative increase in wall time that is accepted.
+
+    Returns
+    -------
+    List[str]
+        One line for each slower step.
+    """
+    slower = []
+    for case, steps in new["results"].items():
+        for step, result in steps.items():
+            before = old["results"].get(case, {}).get(step)
+            if not before or result.get("returncode", 0) or before.get("returncode", 0):
+                continue
+            ratio = result["seconds"] / before["seconds"]
+            if ratio > 1 + tolerance:
+                slower.append(
+                    f"{case} {step}: {before['seconds']:.2f} s -> "
+                    + f"{result['seconds']:.2f} s ({ratio:.2f}x)"
+                )
+    return slower
+
+
+def main() -> None:
+    """Run the benchmarks and save the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", nargs="+", default=["tiny"], choices=list(SIZES), help="Data sizes."
+    )
+    parser.add_argument(
+        "--formats",
+        nargs="+",
+        default=None,
+        help="netCDF formats. All formats in create_data.FileFormat if not given.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Processes writing the history files."
+    )
+    parser.add_argument(
+        "-o", "--output", default=None, help="The JSON file. Named after the commit."
+    )
+    parser.add_argument(
+        "--compare", default=None, help="Results of an earlier run to compare with."
+    )
+    args = parser.parse_args()
+    formats = args.formats or list(cd.FileFormat.__args__)
+    commit = _commit()
+    report = {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "sizes": {s: SIZES[s] for s in args.sizes},
+        "results": {},
+    }
+    for size in args.sizes:
+        for file_format in formats:
+            case = f"{size}/{file_format}"
+            print(f"Running {case}...", flush=True)
+            directory = tempfile.mkdtemp(prefix="cesm_bench_")
+            try:
+                report["results"][case] = run_case(
+                    size, file_format, directory, args.workers
+                )
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+            for step, result in report["results"][case].items():
+                status = "failed" if result.get("returncode") else ""
+                print(f"  {step:22s} {result['seconds']:8.2f} s {status}")
+    output = args.output or f"benchmark_{(commit or 'unknown')[:8]}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("Saved to", output)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            slower = compare(json.load(f), report)
+        print("\n".join(slower) if slower else "No step is slower than before.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,23 @@
-"""Script that generates netCDF files used to test the modules."""
+"""Script that generates netCDF files used to test the modules.
 
+The grid size, the number of levels, the length of the run, the output frequency, the
+variables and the file format can all be set, so the same generator can make the small
+test data set or runs of many GB for performance work. The data are random, but the same
+for a given seed, and each file is written by a pool of worker processes with one bulk
+write per variable.
+
+Usage:
+    python create_data.py
+    python create_data.py --nlat 192 --nlon 288 --years 50 --freq day --workers 8
+"""
+
+import argparse
 import os
 import shutil
-from typing import Literal, Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Literal, Optional, Tuple
 
+import cftime
 import netCDF4
 import numpy as np
 
@@ -14,22 +28,153 @@ FileFormat = Literal[
     "NETCDF3_64BIT_OFFSET",
     "NETCDF3_64BIT_DATA",
 ]
+Frequency = Literal["month", "day"]
+TIME_UNITS = "days since 1850-01-01 00:00:00"
+# Written to the directories made by the generator. Only those are ever emptied.
+MARKER = ".create_data"
+# fmt: off
+ILEV_70 = [
+    4.500500e-06, 7.420100e-06, 1.223370e-05, 2.017000e-05, 3.325450e-05,
+    5.482750e-05, 9.039800e-05, 1.490400e-04, 2.457200e-04, 4.051250e-04,
+    6.679400e-04, 1.101265e-03, 1.815650e-03, 2.993500e-03, 4.963000e-03,
+    8.150651e-03, 1.347700e-02, 2.231900e-02, 3.679650e-02, 6.066500e-02,
+    9.915650e-02, 1.573900e-01, 2.388500e-01, 3.452000e-01, 4.751350e-01,
+    6.318050e-01, 8.291550e-01, 1.082740e+00, 1.406850e+00, 1.818850e+00,
+    2.339800e+00, 2.995050e+00, 3.814700e+00, 4.834450e+00, 6.096350e+00,
+    7.649350e+00, 9.550100e+00, 1.186400e+01, 1.466550e+01, 1.803800e+01,
+    2.207550e+01, 2.688250e+01, 3.257350e+01, 3.927300e+01, 4.711450e+01,
+    5.624050e+01, 6.680050e+01, 8.070142e+01, 9.494104e+01, 1.116932e+02,
+    1.314013e+02, 1.545868e+02, 1.818634e+02, 2.139528e+02, 2.517044e+02,
+    2.961172e+02, 3.483666e+02, 4.098352e+02, 4.821499e+02, 5.672244e+02,
+    6.523330e+02, 7.304459e+02, 7.963631e+02, 8.453537e+02, 8.737159e+02,
+    9.003246e+02, 9.249645e+02, 9.474323e+02, 9.675386e+02, 9.851122e+02,
+    1.000000e+03,
+]
+LEV_70 = [
+    5.960300e-06, 9.826900e-06, 1.620185e-05, 2.671225e-05, 4.404100e-05,
+    7.261275e-05, 1.197190e-04, 1.973800e-04, 3.254225e-04, 5.365325e-04,
+    8.846025e-04, 1.458457e-03, 2.404575e-03, 3.978250e-03, 6.556826e-03,
+    1.081383e-02, 1.789800e-02, 2.955775e-02, 4.873075e-02, 7.991075e-02,
+    1.282732e-01, 1.981200e-01, 2.920250e-01, 4.101675e-01, 5.534700e-01,
+    7.304800e-01, 9.559475e-01, 1.244795e+00, 1.612850e+00, 2.079325e+00,
+    2.667425e+00, 3.404875e+00, 4.324575e+00, 5.465400e+00, 6.872850e+00,
+    8.599725e+00, 1.070705e+01, 1.326475e+01, 1.635175e+01, 2.005675e+01,
+    2.447900e+01, 2.972800e+01, 3.592325e+01, 4.319375e+01, 5.167750e+01,
+    6.152050e+01, 7.375096e+01, 8.782123e+01, 1.033171e+02, 1.215472e+02,
+    1.429940e+02, 1.682251e+02, 1.979081e+02, 2.328286e+02, 2.739108e+02,
+    3.222419e+02, 3.791009e+02, 4.459926e+02, 5.246872e+02, 6.097787e+02,
+    6.913894e+02, 7.634045e+02, 8.208584e+02, 8.595348e+02, 8.870202e+02,
+    9.126445e+02, 9.361984e+02, 9.574855e+02, 9.763254e+02, 9.925561e+02
+]
+# fmt: on
+VARIABLES: Dict[str, Dict] = {
+    "T": {
+        "dims": ("time", "lev", "lat", "lon"),
+        "type": "f4",
+        "units": "K",
+        "mdims": 1,
+        "long_name": "Temperature",
+        "cell_methods": "time: mean",
+    },
+    "TREFHT": {
+        "dims": ("time", "lat", "lon"),
+        "type": "f4",
+        "units": "K",
+        "long_name": "Reference height temperature",
+        "cell_methods": "time: mean",
+    },
+    "FLNT": {
+        "dims": ("time", "lat", "lon"),
+        "type": "f4",
+        "Sampling_Sequence": "rad_lwsw",
+        "units": "W/m2",
+        "long_name": "Net longwave flux at top of model",
+        "cell_methods": "time: mean",
+    },
+    "FSNT": {
+        "dims": ("time", "lat", "lon"),
+        "type": "f4",
+        "Sampling_Sequence": "rad_lwsw",
+        "units": "W/m2",
+        "long_name": "Net solar flux at top of model",
+        "cell_methods": "time: mean",
+    },
+    "AODVISstdn": {
+        "dims": ("time", "lat", "lon"),
+        "type": "f4",
+        "_FillValue": 1e36,
+        # "missing_value": 1e36,
+        "long_name": "Stratospheric aerosol optical depth 550 nm, day night",
+        "cell_methods": "time: mean",
+    },
+}
+CREATOR = (
+    "Example creator. Here, we make the line so long that it has to wrap."
+    " Notice that the line in this case will start on the next line, as opposed"
+    " to the 'description' variable above. Newlines inside the description is"
+    " indented with four spaces, while lines that have been wrapped are"
+    " indented with eight spaces. This is also printed with a dim colour where"
+    " the variable name is. Can you see it?\n It is not so easy to see, but"
+    " that is also the point, since it does not really provide any useful"
+    " information; you only need to know about it and then it should be"
+    " unobtrusive othervise. At this point I dont have anything more to say, I"
+    " am just making sure the line is long enough to get some wrapping."
+)
+
+
+def levels(nlev: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the hybrid levels at midpoints and interfaces in hPa."""
+    if nlev == len(LEV_70):
+        return np.asarray(LEV_70), np.asarray(ILEV_70)
+    ilev = np.geomspace(ILEV_70[0], ILEV_70[-1], nlev + 1)
+    return np.sqrt(ilev[1:] * ilev[:-1]), ilev
 
 
 class Dataset:
-    def __init__(self) -> None:
-        if (
-            here := os.path.basename(abs_path := os.path.abspath("."))
-        ) == "cesm-helper-scripts":
-            self.path = os.path.join("tests", "data")
-        elif here == "tests":
-            self.path = "data"
-        else:
-            raise OSError(
-                "You are in the wrong path or something. I tried to find ./tests/data,"
-                f" but could only find absolute path {abs_path}, and that ends in the"
-                f" {here} directory."
-            )
+    """Generate CESM-like history files.
+
+    Parameters
+    ----------
+    path : Optional[str]
+        The directory of the files, emptied first. It must be empty, or made by this
+        generator before. Defaults to `data/` next to this script.
+    nlat : int
+        Number of latitudes.
+    nlon : int
+        Number of longitudes.
+    nlev : int
+        Number of levels.
+    years : Optional[int]
+        Length of the run in years. If not given, `num_files` monthly files are made.
+    freq : Frequency
+        Output frequency. Monthly output (`h0`) has one time step per file, daily
+        output (`h1`) has one file for each month.
+    variables : Optional[List[str]]
+        The variables to write, from `VARIABLES`. All of them if not given.
+    seed : int
+        Seed of the random data. The same seed gives the same files.
+    workers : int
+        Number of processes writing files.
+    start_year : int
+        The first year of the run.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        nlat: int = 96,
+        nlon: int = 144,
+        nlev: int = 70,
+        years: Optional[int] = None,
+        freq: Frequency = "month",
+        variables: Optional[List[str]] = None,
+        seed: int = 0,
+        workers: int = 1,
+        start_year: int = 1850,
+    ) -> None:
+        self.path = path or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "data"
+        )
         self.clean()
         self.file_format_list: list[FileFormat] = [
             "NETCDF3_CLASSIC",
@@ -39,90 +184,100 @@ class Dataset:
             "NETCDF3_64BIT_DATA",
         ]
         self.format: FileFormat = "NETCDF4_CLASSIC"
-        self.num_files = 10
+        self.num_files = 10 if years is None else 12 * years
+        self.nlat, self.nlon, self.nlev = nlat, nlon, nlev
+        if freq not in ("month", "day"):
+            raise ValueError(f"freq must be month or day, not {freq}")
+        self.freq = freq
+        unknown = set(variables or []) - set(VARIABLES)
+        if unknown:
+            raise ValueError(f"unknown variables {unknown}, use {list(VARIABLES)}")
+        self.names = list(variables or VARIABLES)
+        self.seed = seed
+        self.workers = workers
+        self.start_year = start_year
 
     def set_variables(self) -> None:
         self.variables: dict[str, dict] = {
-            "T": {
-                "dims": ("time", "lev", "lat", "lon"),
-                "type": "f4",
-                "units": "K",
-                "mdims": 1,
-                "long_name": "Temperature",
-                "cell_methods": "time: mean",
-            },
-            "TREFHT": {
-                "dims": ("time", "lat", "lon"),
-                "type": "f4",
-                "units": "K",
-                "long_name": "Reference height temperature",
-                "cell_methods": "time: mean",
-            },
-            "FLNT": {
-                "dims": ("time", "lat", "lon"),
-                "type": "f4",
-                "Sampling_Sequence": "rad_lwsw",
-                "units": "W/m2",
-                "long_name": "Net longwave flux at top of model",
-                "cell_methods": "time: mean",
-            },
-            "FSNT": {
-                "dims": ("time", "lat", "lon"),
-                "type": "f4",
-                "Sampling_Sequence": "rad_lwsw",
-                "units": "W/m2",
-                "long_name": "Net solar flux at top of model",
-                "cell_methods": "time: mean",
-            },
-            "AODVISstdn": {
-                "dims": ("time", "lat", "lon"),
-                "type": "f4",
-                "_FillValue": 1e36,
-                # "missing_value": 1e36,
-                "long_name": "Stratospheric aerosol optical depth 550 nm, day night",
-                "cell_methods": "time: mean",
-            },
+            name: dict(VARIABLES[name]) for name in self.names
         }
 
     def clean(self) -> None:
-        """Clean up the data directory for generated data sets."""
-        if os.path.exists(self.path):
+        """Clean up the data directory for generated data sets.
+
+        Raises
+        ------
+        ValueError
+            If the directory is not empty and was not made by the generator.
+        """
+        if os.path.exists(self.path) and os.listdir(self.path):
+            if not os.path.exists(os.path.join(self.path, MARKER)):
+                raise ValueError(
+                    f"{self.path} is not empty and was not made by create_data, give"
+                    + " an empty or new directory"
+                )
             shutil.rmtree(self.path)
-        os.makedirs(self.path)
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, MARKER), "w"):
+            pass
+
+    def nbytes(self) -> int:
+        """Return the approximate size of all files in bytes."""
+        step = sum(
+            (self.nlev if len(VARIABLES[n]["dims"]) == 4 else 1) * 4 for n in self.names
+        )
+        steps = self.num_files * (30 if self.freq == "day" else 1)
+        return step * self.nlat * self.nlon * steps
 
     def make_datasets(self, format: Optional[FileFormat] = None) -> None:
         self.format = format or self.format
+        self.set_variables()
+        stream = "h0" if self.freq == "month" else "h1"
+        files = []
         for i in range(self.num_files):
-            i_ = "0" * (2 - len(str(i))) + str(i)
-            file_name = f"simulation.cam.h0.1852-{i_}.nc"
-            self.set_variables()
-            self.create_dataset(file_name, i * 30, self.format)
+            year, month = self.start_year + i // 12, i % 12 + 1
+            file_name = f"simulation.cam.{stream}.{year:04d}-{month:02d}.nc"
+            files.append((file_name, i, self.format))
+        if self.workers > 1:
+            with ProcessPoolExecutor(self.workers) as pool:
+                list(pool.map(self._create, files))
+        else:
+            for spec in files:
+                self._create(spec)
 
-    def create_dataset(
-        self, file_name: str, time_stamp: int, format: FileFormat
-    ) -> None:
+    def _create(self, spec: Tuple[str, int, FileFormat]) -> None:
+        self.create_dataset(*spec)
+
+    def time_steps(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the time stamps and bounds of file number `index`.
+
+        As in CESM, the time stamp is at the end of each averaging interval.
+        """
+        year, month = self.start_year + index // 12, index % 12 + 1
+        start = cftime.DatetimeNoLeap(year, month, 1)
+        end = cftime.DatetimeNoLeap(year + month // 12, month % 12 + 1, 1)
+        first, last = cftime.date2num([start, end], TIME_UNITS, "noleap")
+        if self.freq == "month":
+            edges = np.array([first, last])
+        else:
+            edges = np.arange(first, last + 1)
+        bounds = np.stack([edges[:-1], edges[1:]], axis=1)
+        return edges[1:], bounds
+
+    def create_dataset(self, file_name: str, index: int, format: FileFormat) -> None:
+        # One generator per file, so the data do not depend on the number of workers.
+        rng = np.random.default_rng([self.seed, index])
         ds = netCDF4.Dataset(
             os.path.join(self.path, file_name), mode="w", format=format
         )
         ds.description = "Example description"
-        ds.creator = (
-            "Example creator. Here, we make the line so long that it has to wrap."
-            " Notice that the line in this case will start on the next line, as opposed"
-            " to the 'description' variable above. Newlines inside the description is"
-            " indented with four spaces, while lines that have been wrapped are"
-            " indented with eight spaces. This is also printed with a dim colour where"
-            " the variable name is. Can you see it?\n It is not so easy to see, but"
-            " that is also the point, since it does not really provide any useful"
-            " information; you only need to know about it and then it should be"
-            " unobtrusive othervise. At this point I dont have anything more to say, I"
-            " am just making sure the line is long enough to get some wrapping."
-        )
+        ds.creator = CREATOR
         ds.title = ""
-        ds.time_period_freq = "month_1"
-        ds.createDimension("lat", 96)  # latitude axis
-        ds.createDimension("lon", 144)  # longitude axis
-        ds.createDimension("lev", 70)  # level axis
-        ds.createDimension("ilev", 71)  # interfaces levels
+        ds.time_period_freq = f"{self.freq}_1"
+        ds.createDimension("lat", self.nlat)  # latitude axis
+        ds.createDimension("lon", self.nlon)  # longitude axis
+        ds.createDimension("lev", self.nlev)  # level axis
+        ds.createDimension("ilev", self.nlev + 1)  # interfaces levels
         ds.createDimension("chars", 8)  # KeyError: No variable information
         ds.createDimension("nbnd", 2)  # KeyError: No variable information
         ds.createDimension("time")  # unlimited axis (can be appended to).
@@ -132,6 +287,8 @@ class Dataset:
         lon = ds.createVariable("lon", float, ("lon",), fill_value=-900)
         lon.units = "degrees_east"
         lon.long_name = "longitude"
+        gw = ds.createVariable("gw", float, ("lat",))
+        gw.long_name = "latitude weights"
         lev = ds.createVariable("lev", float, ("lev",))
         lev.units = "hPa"
         lev.positive = "down"
@@ -145,85 +302,95 @@ class Dataset:
         ilev.standard_name = "atmosphere_hybrid_sigma_pressure_coordinate"
         ilev.formula_terms = "a: hyai b: hybi p0: P0 ps: PS"
         time = ds.createVariable("time", float, ("time",))
-        time.units = "days since 1850-01-01 00:00:00"
+        time.units = TIME_UNITS
         time.long_name = "time"
         time.calendar = "noleap"
         time.bounds = "time_bnds"
+        time_bnds = ds.createVariable("time_bnds", float, ("time", "nbnd"))
+        time_bnds.long_name = "time interval endpoints"
 
-        nlats = ds.dimensions["lat"].size
-        nlons = ds.dimensions["lon"].size
-        nlevs = ds.dimensions["lev"].size
         # Populate variables with data
-        ds.variables["lat"]
-        ds.variables["lon"]
-        time_ = ds.variables["time"]
-        time_[:] = time_stamp  # Days since 1850
-        lat[:] = -90.0 + (180.0 / nlats) * np.arange(nlats)
-        lon[:] = (180.0 / nlats) * np.arange(nlons)  # Greenwich meridian eastward
-        # fmt: off
-        ilev[:] = [
-            4.500500e-06, 7.420100e-06, 1.223370e-05, 2.017000e-05, 3.325450e-05,
-            5.482750e-05, 9.039800e-05, 1.490400e-04, 2.457200e-04, 4.051250e-04,
-            6.679400e-04, 1.101265e-03, 1.815650e-03, 2.993500e-03, 4.963000e-03,
-            8.150651e-03, 1.347700e-02, 2.231900e-02, 3.679650e-02, 6.066500e-02,
-            9.915650e-02, 1.573900e-01, 2.388500e-01, 3.452000e-01, 4.751350e-01,
-            6.318050e-01, 8.291550e-01, 1.082740e+00, 1.406850e+00, 1.818850e+00,
-            2.339800e+00, 2.995050e+00, 3.814700e+00, 4.834450e+00, 6.096350e+00,
-            7.649350e+00, 9.550100e+00, 1.186400e+01, 1.466550e+01, 1.803800e+01,
-            2.207550e+01, 2.688250e+01, 3.257350e+01, 3.927300e+01, 4.711450e+01,
-            5.624050e+01, 6.680050e+01, 8.070142e+01, 9.494104e+01, 1.116932e+02,
-            1.314013e+02, 1.545868e+02, 1.818634e+02, 2.139528e+02, 2.517044e+02,
-            2.961172e+02, 3.483666e+02, 4.098352e+02, 4.821499e+02, 5.672244e+02,
-            6.523330e+02, 7.304459e+02, 7.963631e+02, 8.453537e+02, 8.737159e+02,
-            9.003246e+02, 9.249645e+02, 9.474323e+02, 9.675386e+02, 9.851122e+02,
-            1.000000e+03,
-        ]
-        lev[:] = [
-            5.960300e-06, 9.826900e-06, 1.620185e-05, 2.671225e-05, 4.404100e-05,
-            7.261275e-05, 1.197190e-04, 1.973800e-04, 3.254225e-04, 5.365325e-04,
-            8.846025e-04, 1.458457e-03, 2.404575e-03, 3.978250e-03, 6.556826e-03,
-            1.081383e-02, 1.789800e-02, 2.955775e-02, 4.873075e-02, 7.991075e-02,
-            1.282732e-01, 1.981200e-01, 2.920250e-01, 4.101675e-01, 5.534700e-01,
-            7.304800e-01, 9.559475e-01, 1.244795e+00, 1.612850e+00, 2.079325e+00,
-            2.667425e+00, 3.404875e+00, 4.324575e+00, 5.465400e+00, 6.872850e+00,
-            8.599725e+00, 1.070705e+01, 1.326475e+01, 1.635175e+01, 2.005675e+01,
-            2.447900e+01, 2.972800e+01, 3.592325e+01, 4.319375e+01, 5.167750e+01,
-            6.152050e+01, 7.375096e+01, 8.782123e+01, 1.033171e+02, 1.215472e+02,
-            1.429940e+02, 1.682251e+02, 1.979081e+02, 2.328286e+02, 2.739108e+02,
-            3.222419e+02, 3.791009e+02, 4.459926e+02, 5.246872e+02, 6.097787e+02,
-            6.913894e+02, 7.634045e+02, 8.208584e+02, 8.595348e+02, 8.870202e+02,
-            9.126445e+02, 9.361984e+02, 9.574855e+02, 9.763254e+02, 9.925561e+02
-        ]
-        # fmt: on
+        times, bounds = self.time_steps(index)
+        time[:] = times  # Days since 1850
+        time_bnds[:] = bounds
+        lat[:] = -90.0 + (180.0 / self.nlat) * np.arange(self.nlat)
+        # The area of each latitude band, summing to 2 as in CAM.
+        edges = np.deg2rad(-90.0 + (180.0 / self.nlat) * np.arange(self.nlat + 1))
+        gw[:] = np.diff(np.sin(edges))
+        lon[:] = (360.0 / self.nlon) * np.arange(
+            self.nlon
+        )  # Greenwich meridian eastward
+        lev[:], ilev[:] = levels(self.nlev)
+        scale = np.arange(self.nlev, dtype="f4")[:, None, None]
         for var_name, var_dict in self.variables.items():
-            if "_FillValue" in var_dict:
-                dims_length = len(dims_ := var_dict.pop("dims"))
-                var = ds.createVariable(
-                    var_name,
-                    var_dict.pop("type"),
-                    dims_,
-                    fill_value=var_dict.pop("_FillValue"),
-                )
-            else:
-                dims_length = len(dims_ := var_dict.pop("dims"))
-                var = ds.createVariable(var_name, var_dict.pop("type"), dims_)
+            var_dict = dict(var_dict)
+            dims_ = var_dict.pop("dims")
+            var = ds.createVariable(
+                var_name,
+                var_dict.pop("type"),
+                dims_,
+                fill_value=var_dict.pop("_FillValue", None),
+            )
             for meta in var_dict.items():
                 setattr(var, meta[0], meta[1])
-            data_slice = np.random.uniform(low=280, high=330, size=(nlats, nlons))
-            data_slice = data_slice[np.newaxis, :]
-            if dims_length == 3:
-                var[:, :, :] = np.asarray(data_slice) * (
-                    np.random.randint(0, 2) * 2 - 1
-                )
-            elif dims_length == 4:
-                for levs in range(nlevs):
-                    var[:, levs, :, :] = np.asarray(data_slice) * levs
+            sign = rng.integers(0, 2) * 2 - 1
+            # All time steps in one write. A file holds at most one month, so the
+            # memory used does not grow with the length of the run.
+            data = 280 + 50 * rng.random((len(times), self.nlat, self.nlon), dtype="f4")
+            if len(dims_) == 3:
+                var[:] = data * sign
+            elif len(dims_) == 4:
+                var[:] = data[:, None] * scale
         ds.close()
 
 
 def main():
-    creator = Dataset()
-    creator.make_datasets()
+    parser = argparse.ArgumentParser(description="Generate CESM-like history files.")
+    parser.add_argument("--path", type=str, default=None, help="Output directory.")
+    parser.add_argument("--nlat", type=int, default=96, help="Number of latitudes.")
+    parser.add_argument("--nlon", type=int, default=144, help="Number of longitudes.")
+    parser.add_argument("--nlev", type=int, default=70, help="Number of levels.")
+    parser.add_argument(
+        "--years",
+        type=int,
+        default=None,
+        help="Length of the run. Ten monthly files are made if not given.",
+    )
+    parser.add_argument(
+        "--freq",
+        type=str,
+        default="month",
+        choices=("month", "day"),
+        help="Output frequency.",
+    )
+    parser.add_argument(
+        "--variables",
+        type=str,
+        nargs="+",
+        default=None,
+        help=f"Any of {list(VARIABLES)}.",
+    )
+    parser.add_argument(
+        "--format", type=str, default="NETCDF4_CLASSIC", help="The netCDF file format."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random data.")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of processes writing files."
+    )
+    args = parser.parse_args()
+    creator = Dataset(
+        args.path,
+        args.nlat,
+        args.nlon,
+        args.nlev,
+        args.years,
+        args.freq,
+        args.variables,
+        args.seed,
+        args.workers,
+    )
+    print(f"Writing about {creator.nbytes() / 1e9:.2f} GB to {creator.path}")
+    creator.make_datasets(args.format)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,14 @@
 """Run the `gen_agg` script on the test data."""
 
+import glob
 import os
 import subprocess
+import tempfile
 import time
 
 import create_data as cd
 import numpy as np
+import xarray as xr
 
 
 class RunGenAgg:
@@ -26,7 +29,8 @@ class RunGenAgg:
         self.script = os.path.join(script_path, "gen_agg")
 
     def get_file_list(self) -> list[str]:
-        return os.listdir(self.data_path)
+        # Only the history files, not aggregated output or the header index.
+        return [f for f in os.listdir(self.data_path) if ".cam.h0." in f]
 
     def simulate(self, splits: int = 1) -> None:
         """Simulate generation of aggregated variables.
@@ -59,6 +63,182 @@ class RunGenAgg:
             ):
                 print(f"Return code: {return_code}")
 
+    def simulate_workers(self, workers: int = 1, scheduler: str = "processes") -> None:
+        """Simulate generation of aggregated variables split over several workers.
+
+        Parameters
+        ----------
+        workers : int
+            Specify the number of workers the input files are split between.
+        scheduler : str
+            Run the workers in a process pool ("processes") or in a local
+            dask.distributed cluster ("distributed").
+        """
+        if return_code := subprocess.call(
+            [
+                "python",
+                self.script,
+                "-a",
+                "FLNT",
+                "-p",
+                self.data_path,
+                "-i",
+                *sorted(self.get_file_list()),
+                "-o",
+                f"FLNT_{scheduler}",
+                "--workers",
+                str(workers),
+                "--scheduler",
+                scheduler,
+            ]
+        ):
+            print(f"Return code: {return_code}")
+
+    def check_reduce_global(self, workers: int = 2) -> None:
+        """Check that the global mean is the same with and without workers.
+
+        Parameters
+        ----------
+        workers : int
+            Specify the number of workers the input files are split between.
+
+        Raises
+        ------
+        ValueError
+            If the global means differ.
+        """
+        outputs = {}
+        for name, extra in (("serial", []), ("workers", ["--workers", str(workers)])):
+            subprocess.check_call(
+                [
+                    "python",
+                    self.script,
+                    "-a",
+                    "TREFHT",
+                    "-p",
+                    self.data_path,
+                    "-i",
+                    *sorted(self.get_file_list()),
+                    "-o",
+                    f"TREFHT_{name}",
+                    "-sp",
+                    "input",
+                    "--reduce",
+                    "global",
+                    *extra,
+                ]
+            )
+            file = os.path.join(self.data_path, f"TREFHTTREFHT_{name}_global.nc")
+            with xr.open_dataset(file) as ds:
+                outputs[name] = ds["TREFHT"].values
+        if not np.allclose(outputs["serial"], outputs["workers"]):
+            raise ValueError(
+                f"The global mean with {workers} workers differs from the serial run"
+                f" by up to {np.abs(outputs['serial'] - outputs['workers']).max()}"
+            )
+
+    def check_part_years(self, part_years: int = 3, years: int = 7) -> None:
+        """Check that `--part-years` splits monthly noleap data on year boundaries.
+
+        Parameters
+        ----------
+        part_years : int
+            Number of model years in each part.
+        years : int
+            Length of the generated run in years.
+
+        Raises
+        ------
+        ValueError
+            If a part does not start in January, or has the wrong number of months.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            cd.Dataset(
+                directory, nlat=4, nlon=8, nlev=2, years=years, variables=["TREFHT"]
+            ).make_datasets()
+            subprocess.check_call(
+                [
+                    "python",
+                    self.script,
+                    "-a",
+                    "TREFHT",
+                    "-p",
+                    directory,
+                    "-i",
+                    "simulation.cam.h0.*",
+                    "-o",
+                    "parts",
+                    "-sp",
+                    "input",
+                    "--part-years",
+                    str(part_years),
+                ]
+            )
+            parts = sorted(
+                glob.glob(os.path.join(directory, "TREFHTparts-*.nc")),
+                key=lambda f: int(f.split("-")[-1][:-3]),
+            )
+            expected = [12 * part_years] * (years // part_years)
+            expected += [12 * (years % part_years)] if years % part_years else []
+            lengths = []
+            for part in parts:
+                with xr.open_dataset(part) as ds:
+                    lengths.append(ds.sizes["time"])
+                    # The time stamp of the January mean is 1 February.
+                    first = ds.time.values[0]
+                    if (first.month, first.day) != (2, 1):
+                        raise ValueError(f"{part} starts at {first}, not in January")
+            if lengths != expected:
+                raise ValueError(f"The parts have {lengths} months, not {expected}")
+
+    def check_climatology(self, years: int = 2) -> None:
+        """Check the monthly climatology of an aggregate without time bounds.
+
+        The files written by `gen_agg` have no `time_bnds`, so the months must be found
+        from the time stamps, which are at the end of each month.
+
+        Parameters
+        ----------
+        years : int
+            Length of the generated run in years.
+
+        Raises
+        ------
+        ValueError
+            If the January climatology is not the mean of the January data.
+        """
+        from cesm_helper_scripts import climatology
+
+        with tempfile.TemporaryDirectory() as directory:
+            cd.Dataset(
+                directory, nlat=4, nlon=8, nlev=2, years=years, variables=["TREFHT"]
+            ).make_datasets()
+            subprocess.check_call(
+                [
+                    "python",
+                    self.script,
+                    "-a",
+                    "TREFHT",
+                    "-p",
+                    directory,
+                    "-i",
+                    "simulation.cam.h0.*",
+                    "-o",
+                    "clim",
+                    "-sp",
+                    "input",
+                ]
+            )
+            file = os.path.join(directory, "TREFHTclim.nc")
+            clim_file, _ = climatology.run(file, ["TREFHT"])
+            with xr.open_dataset(file) as ds, xr.open_dataset(clim_file) as clim:
+                if "time_bnds" in ds:
+                    raise ValueError(f"{file} has time bounds, nothing is checked")
+                # The time stamp of the January mean is 1 February.
+                january = ds.TREFHT[ds.time.dt.month == 2].mean("time")
+                if not np.allclose(clim.TREFHT[0], january):
+                    raise ValueError("the January climatology is not of January")
+
 
 def main() -> None:
     creator = cd.Dataset()
@@ -70,6 +250,11 @@ def main() -> None:
         creator.make_datasets(file_format_)
         s = RunGenAgg()
         s.simulate(3)
+        s.simulate_workers(3, "processes")
+        s.simulate_workers(3, "distributed")
+        s.check_reduce_global(2)
+        s.check_part_years()
+        s.check_climatology()
         print(f"Success! {file_format_} files works.")
         time.sleep(1.5)
 